@@ -3,29 +3,36 @@ import os
 import logging
 import argparse
 
-import celery
-from celery import Celery
+from utils import startup_util  # 启动耗时分析，需要最先 import
 
-import settings
-from utils import celery_util, log_filter
+with startup_util.phase('import celery'):
+    import celery
+    from celery import Celery, concurrency
+
+with startup_util.phase('settings'):
+    import settings
+with startup_util.phase('log_filter'):
+    from utils import log_filter
+with startup_util.phase('import celery_util'):
+    from utils import celery_util
 
 logger = logging.getLogger(__name__)
 
-celery_app = Celery(settings.APP_NAME)
-celery_app.config_from_object(settings.CELERY_CONFIG)
+with startup_util.phase('celery app'):
+    celery_app = Celery(settings.APP_NAME)
+    celery_app.config_from_object(settings.CELERY_CONFIG)
 
-celery_util.load_task('tasks', celery_app)  # 加载 tasks 目录下的任务
+with startup_util.phase('load_task'):
+    celery_util.load_task('tasks', celery_app)  # 加载 tasks 目录下的任务
 # logger.info(f'Celery config: {celery_app.conf}')
 
-celery_util.clear_tasks()  # 清除 celery 旧任务
-
 
 def run():
     """
     启动 celery 任务
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument('-m', '--mode', choices=['worker', 'beat'])
+    parser.add_argument('-m', '--mode', choices=['worker', 'beat', 'pulsar-bridge'])
     parser.add_argument('--pool',
                         choices=['solo', 'gevent', 'prefork', 'eventlet', 'processes', 'threads', 'custom'],
                         default='solo')  # 并发模型，可选：prefork (默认，multiprocessing), eventlet, gevent, threads.
@@ -38,7 +45,17 @@ def run():
     parser.add_argument('--basic-auth', default='{}:{}'.format(settings.MONITOR_USERNAME, settings.MONITOR_PASSWORD))
     args, unknown_args = parser.parse_known_args()
     logfile = args.logfile or f'logs/{args.mode}.log'
-    log_filter.add_file_handler(logfile, args.loglevel)
+    with startup_util.phase('log_filter setup'):
+        log_filter.add_file_handler(logfile, args.loglevel)
+        log_filter.setup_log_queue()  # 环境变量 LOG_QUEUE 启用日志队列
+    if startup_util.enabled():
+        with startup_util.phase('broker connect'):
+            with celery_app.connection_for_write() as conn:
+                conn.ensure_connection(max_retries=3)
+    if args.mode in ('worker', 'beat') and settings.CLEAR_TASKS_ON_START:
+        with startup_util.phase('clear_tasks'):
+            celery_util.clear_tasks()  # 清除各队列的旧任务(同一次部署只清除一次)
+    startup_util.report()  # 环境变量 STARTUP_TRACE/STARTUP_BUDGET 启用
     celery_argv = ['celery'] if celery.__version__ < '5.2.0' else []
 
     host = os.environ.get('HOST') or '0.0.0.0'
@@ -47,6 +64,10 @@ def run():
         port = int(args.port)
 
     if args.mode == 'worker':
+        # 自定义任务池，默认使用 asyncio 任务池(async 任务在同一个事件循环上并发执行)
+        if args.pool == 'custom':
+            os.environ.setdefault('CELERY_CUSTOM_WORKER_POOL', 'utils.asyncio_pool:TaskPool')
+            concurrency.ALIASES['custom'] = os.environ['CELERY_CUSTOM_WORKER_POOL']
         celery_argv += ['worker', '-l', args.loglevel, '--pool', args.pool, '-Q', args.queues]
         '''
         if args.pool == 'gevent':
@@ -60,6 +81,11 @@ def run():
         celery_app.start(argv=celery_argv + unknown_args)
     elif args.mode == 'beat':
         celery_app.start(argv=celery_argv + ['beat', '-l', args.loglevel] + unknown_args)
+    elif args.mode == 'pulsar-bridge':
+        # pulsar 消息批量转发到 celery 队列，-c 为同时在转发中的批次数量上限
+        from utils import pulsar_util
+        pulsar_util.run_bridge(queues=args.queues.split(','),
+                               max_in_flight=int(args.concurrency) if args.concurrency else None)
     elif args.mode == 'monitor':
         celery_app.start(argv=celery_argv + ['flower', '--basic-auth=' + args.basic_auth,
                                              '--address=' + host, '--port=' + str(port)])
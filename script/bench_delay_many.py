@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+"""
+批量抛出任务的性能对比: 逐个 delay 与 delay_many
+BROKER_URL=redis://:@127.0.0.1:6379/1 python3 script/bench_delay_many.py 10000
+注意: 会往 broker 里写入任务，并在结束时清空 fetch_queue 队列
+"""
+import os
+import sys
+import time
+
+# 目录地址配置
+current_dir, _ = os.path.split(__file__)
+CURRENT_DIR = current_dir or os.getcwd()  # 当前目录
+SOURCE_PATH = os.path.abspath(os.path.dirname(CURRENT_DIR))  # 上一层目录，认为是源目录
+sys.path.insert(0, SOURCE_PATH)
+os.chdir(SOURCE_PATH)
+
+import settings
+from main import celery_app
+from tasks.master_fetch import fetch_task
+
+
+def purge():
+    with celery_app.connection_for_write() as conn:
+        conn.default_channel.queue_purge(settings.FETCH_TASK_QUEUE)
+
+
+def bench_delay(total):
+    start = time.time()
+    for i in range(total):
+        fetch_task.delay(i, start)
+    return time.time() - start
+
+
+def bench_delay_many(total):
+    start = time.time()
+    results = fetch_task.delay_many((i, start) for i in range(total))
+    duration = time.time() - start
+    assert sum(1 for _ in results) == total
+    return duration
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(f'broker: {settings.CELERY_CONFIG.broker_url}, tasks: {total}')
+    for name, fun in (('delay', bench_delay), ('delay_many', bench_delay_many)):
+        purge()
+        duration = fun(total)
+        print(f'{name:12s} {duration:8.3f}s  {total / duration:10.1f} tasks/s')
+    purge()
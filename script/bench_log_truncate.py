@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+"""
+日志参数截取的性能对比: deep_short_log(逐层重建容器，每个元素都转字符串) 与 budget_str(按字符预算单次遍历)
+python3 script/bench_log_truncate.py
+"""
+import io
+import os
+import sys
+import time
+import timeit
+import logging
+
+# 目录地址配置
+current_dir, _ = os.path.split(__file__)
+CURRENT_DIR = current_dir or os.getcwd()  # 当前目录
+SOURCE_PATH = os.path.abspath(os.path.dirname(CURRENT_DIR))  # 上一层目录，认为是源目录
+sys.path.insert(0, SOURCE_PATH)
+
+from utils.log_filter import deep_short_log, budget_str, StringFilter, LOG_PARAM_LEN
+
+
+def make_payloads():
+    """几种数 MB 的日志参数"""
+    big_list = list(range(500000))
+    big_dict = {f'key-{i}': {'name': f'item-{i}', 'tags': ['a', 'b', 'c'], 'count': i} for i in range(50000)}
+    big_str = 'x' * (5 * 1024 * 1024)
+    rows = [{'id': i, 'payload': 'y' * 200, 'values': list(range(20))} for i in range(20000)]
+    return {'list[500k int]': big_list, 'dict[50k dict]': big_dict, 'str[5MB]': big_str, 'list[20k row]': rows}
+
+
+def old_way(value):
+    """原来 StringFilter 的处理: 完整格式化保存原值，再 deep_short_log 后格式化"""
+    record_old_msg = 'params: %s' % (value,)  # noqa: F841 原来的 getMessage()
+    return 'params: %s' % (deep_short_log((value,), length=LOG_PARAM_LEN),)
+
+
+def new_way(value):
+    return 'params: %s' % (budget_str(value, LOG_PARAM_LEN),)
+
+
+def bench(name, value, number=3):
+    old = timeit.timeit(lambda: old_way(value), number=number) / number
+    new = timeit.timeit(lambda: new_way(value), number=number) / number
+    print(f'{name:16s} deep_short_log: {old * 1000:10.2f} ms, budget_str: {new * 1000:8.3f} ms, {old / new:10.1f}x')
+
+
+def make_logger():
+    """与实际日志一样经过 StringFilter 的 logger(输出到内存)"""
+    handler = logging.StreamHandler(io.StringIO())
+    handler.addFilter(StringFilter())
+    test_logger = logging.getLogger('bench_log_truncate')
+    test_logger.addHandler(handler)
+    test_logger.setLevel(logging.INFO)
+    test_logger.propagate = False
+    return test_logger
+
+
+def bench_logger(test_logger, value, number=3):
+    """经过 logger 的耗时: 唯一的参数是 dict 时，logging 把 record.args 设为 dict 本身"""
+    single = timeit.timeit(lambda: test_logger.info('%s', value), number=number) / number
+    multi = timeit.timeit(lambda: test_logger.info('%s %s', value, 1), number=number) / number
+    print(f"{'logger.info':16s} '%s' 单个 dict: {single * 1000:8.3f} ms, '%s %s' 多个参数: {multi * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    start = time.time()
+    payloads = make_payloads()
+    print(f'构造数据耗时: {time.time() - start:.2f}s, LOG_PARAM_LEN: {LOG_PARAM_LEN}')
+    for name, value in payloads.items():
+        assert len(new_way(value)) < LOG_PARAM_LEN * 2  # 按预算截取，不会超出太多
+        bench(name, value)
+    bench_logger(make_logger(), payloads['dict[50k dict]'])
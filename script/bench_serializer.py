@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+"""
+序列化性能对比: bson_util(json) 与 msgpack_util(msgpack)
+python3 script/bench_serializer.py
+"""
+import os
+import sys
+import time
+import uuid
+import decimal
+import datetime
+import timeit
+
+# 目录地址配置
+current_dir, _ = os.path.split(__file__)
+CURRENT_DIR = current_dir or os.getcwd()  # 当前目录
+SOURCE_PATH = os.path.abspath(os.path.dirname(CURRENT_DIR))  # 上一层目录，认为是源目录
+sys.path.insert(0, SOURCE_PATH)
+
+from bson.objectid import ObjectId
+from utils.bson_util import bson_dumps, bson_loads
+from utils.msgpack_util import msgpack_dumps, msgpack_loads
+
+
+def make_payload(size=100):
+    """模拟 celery 任务参数: (args, kwargs, embed)"""
+    items = [{
+        'id': ObjectId(),
+        'uuid': uuid.uuid4(),
+        'created': datetime.datetime.now().replace(microsecond=0),
+        'day': datetime.date.today(),
+        'price': decimal.Decimal('12.34'),
+        'name': f'item-{i}',
+        'tags': ['a', 'b', 'c'],
+        'count': i,
+    } for i in range(size)]
+    return [[items], {'ts': time.localtime(), 'company_id': 'c1'}, {'callbacks': None, 'errbacks': None}]
+
+
+def check_round_trip(dumps, loads, payload):
+    """检查编码再解码后值不变(json 编码的 Decimal 会转成 float，精度有损失，只比较近似值)"""
+    result = loads(dumps(payload))
+    for item, origin in zip(result[0][0], payload[0][0]):
+        assert float(item.pop('price')) == float(origin['price'])
+        assert item == {k: v for k, v in origin.items() if k != 'price'}, item
+    assert list(result[1]['ts']) == list(payload[1]['ts'])  # struct_time 是 tuple 子类，两种编码都会转成 list
+    assert result[2] == payload[2]
+
+
+def check_datetime_round_trip():
+    """msgpack 编码的 datetime 保留时区及微秒，超出时间戳范围的也可以编码"""
+    tz = datetime.timezone(datetime.timedelta(hours=8))
+    values = [
+        datetime.datetime(2024, 5, 6, 7, 8, 9, 123456),
+        datetime.datetime(2024, 5, 6, 7, 8, 9, 123456, tzinfo=tz),
+        datetime.datetime(2024, 5, 6, tzinfo=datetime.timezone.utc),
+        datetime.datetime.min,
+        datetime.datetime.max,
+        datetime.date.min,
+    ]
+    for value in values:
+        result = msgpack_loads(msgpack_dumps(value))
+        assert result == value and type(result) is type(value), (value, result)
+        if isinstance(value, datetime.datetime):
+            assert result.utcoffset() == value.utcoffset(), (value, result)
+
+
+def bench(name, dumps, loads, payload, number=200):
+    data = dumps(payload)
+    encode = timeit.timeit(lambda: dumps(payload), number=number)
+    decode = timeit.timeit(lambda: loads(data), number=number)
+    print(f'{name:8s} size: {len(data):8d} bytes, encode: {number / encode:9.1f} ops/s, decode: {number / decode:9.1f} ops/s')
+
+
+if __name__ == "__main__":
+    payload = make_payload()
+    for name, dumps, loads in (('json', bson_dumps, bson_loads), ('msgpack', msgpack_dumps, msgpack_loads)):
+        check_round_trip(dumps, loads, make_payload())
+        bench(name, dumps, loads, payload)
+    check_datetime_round_trip()
+    # msgpack 编码 Decimal 没有精度损失
+    assert msgpack_loads(msgpack_dumps(payload))[0][0][0]['price'] == decimal.Decimal('12.34')
@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+"""
+pulsar 发送消息的检查(使用内存里的假 pulsar 客户端，不需要 pulsar 服务): 同步发送、异步批量发送、退出时发完缓存的消息，
+以及 KeyShared 订阅的分片(Sticky)
+python3 script/check_pulsar_send.py
+"""
+import os
+import sys
+import enum
+import types
+
+# 目录地址配置
+current_dir, _ = os.path.split(__file__)
+CURRENT_DIR = current_dir or os.getcwd()  # 当前目录
+SOURCE_PATH = os.path.abspath(os.path.dirname(CURRENT_DIR))  # 上一层目录，认为是源目录
+sys.path.insert(0, SOURCE_PATH)
+
+
+class FakeProducer(object):
+    """假的生产者: send_async 的消息先缓存，flush 时才“发出”并回调(与开启 batching 的生产者一致)"""
+
+    def __init__(self, client, topic, **options):
+        self.client = client
+        self.topic = topic
+        self.options = options
+        self.pending = []
+        self.closed = False
+
+    def send(self, data, **options):
+        return self.client.deliver(self.topic, data, options)
+
+    def send_async(self, data, callback, **options):
+        self.pending.append((data, callback, options))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for data, callback, options in pending:
+            if self.client.fail:
+                callback(FakePulsar.Result.Timeout, None)
+            else:
+                callback(FakePulsar.Result.Ok, self.client.deliver(self.topic, data, options))
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+
+class FakeClient(object):
+    def __init__(self, url, **options):
+        self.producers = []
+        self.sent = []
+        self.fail = False
+
+    def create_producer(self, topic, **options):
+        producer = FakeProducer(self, topic, **options)
+        self.producers.append(producer)
+        return producer
+
+    def deliver(self, topic, data, options):
+        self.sent.append((topic, data, options))
+        return f'msg-{len(self.sent)}'
+
+    def subscribe(self, topic, subscription_name, **options):
+        # 与 pulsar.Client.subscribe 一致: key_shared_policy 必须是 ConsumerKeySharedPolicy
+        policy = options.get('key_shared_policy')
+        if policy is not None and not isinstance(policy, FakePulsar.ConsumerKeySharedPolicy):
+            raise ValueError(f'key_shared_policy 类型不对: {policy!r}')
+        self.subscribed = (topic, subscription_name, options)
+        return object()
+
+    def close(self):
+        pass
+
+
+class FakePulsar(types.ModuleType):
+    class Result(enum.Enum):
+        Ok = 0
+        Timeout = 1
+
+    class CompressionType(enum.Enum):
+        LZ4 = 1
+        ZLib = 2
+
+    class BatchingType(enum.Enum):
+        Default = 0
+        KeyBased = 1
+
+    class ConsumerType(enum.Enum):
+        Exclusive = 0
+        Shared = 1
+        Failover = 2
+        KeyShared = 3
+
+    class KeySharedMode(enum.Enum):
+        AutoSplit = 0
+        Sticky = 1
+
+    class ConsumerKeySharedPolicy(object):
+        """与 pulsar.ConsumerKeySharedPolicy 的参数一致"""
+
+        def __init__(self, key_shared_mode=None, allow_out_of_order_delivery=False, sticky_ranges=None):
+            self.key_shared_mode = key_shared_mode
+            self.sticky_ranges = sticky_ranges
+
+    class KeySharedPolicy(object):
+        """pulsar 底层绑定的类，构造函数不接受参数，也不能直接传给 subscribe"""
+
+        def __init__(self):
+            pass
+
+    class ConsumerBatchReceivePolicy(object):
+        def __init__(self, max_num_message, max_num_bytes, timeout_ms):
+            pass
+
+    class Timeout(Exception):
+        pass
+
+    Client = FakeClient
+
+
+sys.modules['pulsar'] = FakePulsar('pulsar')
+os.environ.setdefault('PULSAR_TOPIC_PREFIX', 'persistent://public/default/')
+
+from utils import pulsar_util  # noqa: E402
+
+
+def check():
+    # 同步发送(默认): 返回 MessageId
+    msg_id = pulsar_util.send_message('task_a', args=[1], queue='q1', company_id='c1')
+    client = pulsar_util.get_client()
+    assert msg_id == 'msg-1', msg_id
+    assert client.sent[0][2] == {'partition_key': 'c1'}, client.sent[0]
+
+    # 异步发送: 缓存在生产者里，flush 之前没有发出
+    futures = [pulsar_util.send_message('task_b', args=[i], queue='q2', sync=False) for i in range(5)]
+    assert len(client.sent) == 1 and not any(f.done() for f in futures)
+    producer = pulsar_util.PRODUCERS['persistent://public/default/q2']
+    assert producer.options['batching_enabled'] and producer.options['block_if_queue_full']
+    assert producer.options['batching_type'] == FakePulsar.BatchingType.KeyBased
+
+    # 每个 topic 一个生产者
+    assert set(pulsar_util.PRODUCERS) == {'persistent://public/default/q1', 'persistent://public/default/q2'}
+
+    # 退出时(worker_shutdown/atexit)发完缓存的消息，future 拿到 MessageId
+    pulsar_util.close()
+    assert [f.result(timeout=1) for f in futures] == [f'msg-{i}' for i in range(2, 7)]
+    assert all(p.closed for p in client.producers) and not pulsar_util.PRODUCERS
+
+    # 发送失败: future 抛出 PulsarSendError，回调也会收到结果
+    results = []
+    future = pulsar_util.send_message('task_c', queue='q3', sync=False, callback=lambda r, m: results.append(r))
+    pulsar_util.get_client().fail = True
+    pulsar_util.flush()
+    assert isinstance(future.exception(timeout=1), pulsar_util.PulsarSendError)
+    assert results == [FakePulsar.Result.Timeout]
+    pulsar_util.close()
+
+
+def check_key_shared():
+    # KeyShared 订阅分 2 片: 第 2 片固定消费 key 哈希范围的后半段
+    for name, value in (('PULSAR_CONSUMER_TYPE', 'KeyShared'), ('PULSAR_SHARD_COUNT', '2'), ('PULSAR_SHARD_INDEX', '1'),
+                        ('PULSAR_TOPIC', 'persistent://public/default/q1')):
+        setattr(pulsar_util.config, name, value)
+    pulsar_util.CONSUMER = None
+    pulsar_util.get_consumer()
+    options = pulsar_util.get_client().subscribed[2]
+    assert options['consumer_type'] == FakePulsar.ConsumerType.KeyShared
+    policy = options['key_shared_policy']
+    assert policy.key_shared_mode == FakePulsar.KeySharedMode.Sticky
+    assert policy.sticky_ranges == [(32768, 65535)], policy.sticky_ranges
+
+    # 只有 1 片时由 broker 自动划分
+    pulsar_util.config.PULSAR_SHARD_COUNT = '1'
+    pulsar_util.CONSUMER = None
+    pulsar_util.get_consumer()
+    assert 'key_shared_policy' not in pulsar_util.get_client().subscribed[2]
+    pulsar_util.CONSUMER = None
+
+
+if __name__ == "__main__":
+    check()
+    check_key_shared()
+    print('pulsar 发送检查通过')
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio 任务池(使用: python3 main.py -m worker --pool custom -c 100)
+每个 worker 进程只有一个事件循环(在单独的线程里运行)，async 任务都在这个事件循环上并发执行，最多同时执行 concurrency 个任务。
+async 任务的整个执行过程(celery 的 tracer、BaseTask.__call__ 等同步代码)运行在事件循环线程的 greenlet 里，
+执行到协程时切回事件循环等待，不占用线程：-c 100 就是一个事件循环上的 100 个协程，而不是 100 个线程。
+同步任务(及判断不出是 async 的任务)则跟 threads 任务池一样在线程里执行。
+任务仍然经过 BaseTask.__call__ 执行，ack、重试、超时等处理不变。不需要 gevent 的 monkey patch。
+"""
+import os
+import sys
+import time
+import asyncio
+import inspect
+import logging
+import threading
+
+import greenlet
+from billiard.einfo import ExceptionInfo
+from celery.concurrency import thread
+from celery.exceptions import TimeLimitExceeded, WorkerLostError
+
+from .celery_base_task import BaseTask
+
+logger = logging.getLogger(__name__)
+
+
+class _TaskGreenlet(greenlet.greenlet):
+    """在事件循环线程里执行任务的 greenlet(需要等待时，切回事件循环)"""
+
+
+async def greenlet_spawn(fn, *args, **kwargs):
+    """在 greenlet 里执行同步函数 fn，fn 里可以用 await_only 执行协程"""
+    context = _TaskGreenlet(fn, greenlet.getcurrent())
+    result = context.switch(*args, **kwargs)
+    while not context.dead:
+        # fn 里的协程需要等待: result 是 (等待的 future, 剩余的时间限制)
+        future, timeout = result
+        try:
+            if future is None:  # 协程里的 asyncio.sleep(0) 等，只是让出一次
+                await asyncio.sleep(0)
+            else:
+                done, _ = await asyncio.wait({future}, timeout=timeout)
+                if not done:
+                    raise asyncio.TimeoutError()
+        except BaseException:
+            result = context.throw(*sys.exc_info())
+        else:
+            result = context.switch()
+    return result
+
+
+def in_task_greenlet():
+    """当前是否在 greenlet_spawn 执行的函数里"""
+    return isinstance(greenlet.getcurrent(), _TaskGreenlet)
+
+
+def await_only(coro, timeout=None):
+    """
+    在 greenlet_spawn 执行的同步函数里执行协程
+    协程的每一步都在当前 greenlet 里执行(celery 的 current_task、self.request 等按 greenlet 区分，协程里也能拿到)，
+    需要等待时切回事件循环，等待完成再切回来继续执行
+    :param timeout: 时间限制(秒)，超时则关闭协程并抛出 TimeLimitExceeded
+    """
+    current = greenlet.getcurrent()
+    if not isinstance(current, _TaskGreenlet):
+        raise RuntimeError('await_only 只能在 greenlet_spawn 执行的函数里调用')
+    deadline = time.monotonic() + timeout if timeout else None
+    exc = None
+    while True:
+        try:
+            future = coro.throw(exc) if exc is not None else coro.send(None)
+        except StopIteration as e:
+            return e.value
+        exc = None
+        if future is not None:
+            if not asyncio.isfuture(future):
+                coro.close()
+                raise RuntimeError(f'协程等待的不是 asyncio 的 future: {future!r}')
+            future._asyncio_future_blocking = False  # 与 asyncio.Task 的处理一致
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            current.parent.switch((future, remaining))
+        except asyncio.TimeoutError:
+            # 超时: 取消等待中的 future，关闭协程(协程里的 finally 会执行)
+            if future is not None:
+                future.cancel()
+            coro.close()
+            raise TimeLimitExceeded(timeout)
+        except BaseException as e:  # 如任务池关闭时取消，交给协程处理
+            exc = e
+
+
+class TaskPool(thread.TaskPool):
+    """asyncio 任务池"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self._loop_thread = None
+        self._semaphore = None  # 限制事件循环上同时执行的任务数量
+        self._active = 0  # 事件循环上执行中的任务数量(只在事件循环线程里修改)
+        self._async_tasks = {}  # 缓存 {任务名: 是否 async 任务}
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.app.set_current()  # 事件循环线程里的任务需要拿到当前的 app
+        self.loop.run_forever()
+
+    def on_start(self):
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self._loop_thread = threading.Thread(target=self._run_loop, name='AsyncioPoolLoop', daemon=True)
+        self._loop_thread.start()
+        BaseTask.shared_loop = self.loop
+        logger.info('asyncio 任务池启动，并发数: %s', self.limit)
+
+    def on_stop(self):
+        super().on_stop()  # 等待线程里执行中的任务结束
+        if self.loop is not None:
+            # 等待事件循环上执行中的任务结束
+            pending = asyncio.run_coroutine_threadsafe(self._wait_idle(), self.loop)
+            pending.result()
+            BaseTask.shared_loop = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._loop_thread.join()
+            self.loop.close()
+            self.loop = None
+
+    async def _wait_idle(self):
+        while self._active:
+            await asyncio.sleep(0.1)
+
+    def _is_async(self, task_name):
+        """是否 async 任务(装饰过的 async 函数可能判断不出来，这些任务在线程里执行，协程仍提交到事件循环)"""
+        is_async = self._async_tasks.get(task_name)
+        if is_async is None:
+            task = self.app.tasks.get(task_name)
+            run = getattr(task, 'run', None)
+            is_async = self._async_tasks[task_name] = bool(run) and inspect.iscoroutinefunction(inspect.unwrap(run))
+        return is_async
+
+    def on_apply(self, target, args=None, kwargs=None, callback=None, accept_callback=None, **_):
+        # worker 提交的 target 是 celery 的 trace 函数，第一个参数是任务名
+        if not args or not isinstance(args[0], str) or not self._is_async(args[0]):
+            return super().on_apply(target, args, kwargs, callback, accept_callback)
+        future = asyncio.run_coroutine_threadsafe(self._run(target, args, kwargs or {}, accept_callback), self.loop)
+        future.add_done_callback(lambda f: self._on_done(f, callback))
+        return thread.ApplyResult(future)
+
+    async def _run(self, target, args, kwargs, accept_callback):
+        """在事件循环上执行任务(拿到并发名额才开始)"""
+        async with self._semaphore:
+            self._active += 1
+            try:
+                if accept_callback:
+                    accept_callback(os.getpid(), time.monotonic())
+                return await greenlet_spawn(target, *args, **kwargs)
+            finally:
+                self._active -= 1
+
+    @staticmethod
+    def _on_done(future, callback):
+        """任务执行完毕，回调 worker(与 celery.concurrency.base.apply_target 的处理一致)"""
+        if future.cancelled():
+            if callback:
+                try:
+                    raise WorkerLostError('任务被取消')
+                except WorkerLostError:
+                    callback(ExceptionInfo())
+            return
+        exc = future.exception()
+        if exc is None:
+            if callback:
+                callback(future.result())
+        elif isinstance(exc, Exception):
+            logger.error('asyncio 任务池执行任务出错: %r', exc, exc_info=exc)
+        elif callback:
+            try:
+                raise WorkerLostError(repr(exc)) from exc
+            except WorkerLostError:
+                callback(ExceptionInfo())
+
+    def _get_info(self):
+        info = super()._get_info()
+        info['loop-tasks'] = self._active
+        return info
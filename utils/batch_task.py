@@ -0,0 +1,206 @@
+# -*- coding:utf-8 -*-
+"""
+消费端微批处理任务基类
+
+worker 收到同一任务的消息后先缓存，攒够 flush_every 条或者过了 flush_interval 毫秒，
+再一次性调用 run(batch)，然后按每条的执行结果逐条 ack / 重试。
+适合数据库 upsert、批量发通知这类批量执行远比逐条执行便宜的任务。
+
+用法:
+    class SaveTask(BatchTask):
+        name = 'save'
+        flush_every = 200
+        flush_interval = 500
+
+        def run(self, batch):  # 也可以是 async def
+            db.bulk_upsert([item.args[0] for item in batch])
+            return None  # 全部成功; 也可以返回与 batch 等长的 list，其中 Exception 实例表示该条失败
+
+注意: 未 ack 的消息受 prefetch 限制，worker 的 concurrency * worker_prefetch_multiplier 需要不小于 flush_every，
+否则攒不满一批，只能等 flush_interval 超时才执行。
+"""
+import time
+import logging
+import threading
+from collections import namedtuple
+
+from celery import current_app
+from celery.utils.imports import symbol_by_name
+from celery.utils.time import timezone
+from celery.worker.request import create_request_cls
+from celery.worker.strategy import hybrid_to_proto2, proto1_to_proto2
+from kombu.asynchronous.timer import to_timestamp
+
+from . import blob_util, metrics_util
+from .celery_base_task import BaseTask, TASK_MAX_RETRIES, TASK_RETRY_DELAY
+
+logger = logging.getLogger(__name__)
+
+# 批次里的一条消息
+BatchItem = namedtuple('BatchItem', ('id', 'args', 'kwargs', 'retries'))
+
+
+class BatchTask(BaseTask):
+    Strategy = 'utils.batch_task:batch_strategy'
+    flush_every = 100  # 攒够多少条消息执行一次
+    flush_interval = 1000  # 最多等待多久执行一次(单位:毫秒)
+
+    def run(self, batch):
+        """批量执行，batch 是 BatchItem 的 list"""
+        raise NotImplementedError('BatchTask 子类需要实现 run(batch)')
+
+
+def _give_up(error, retries):
+    """失败后是否不再重试: 重试次数已用完，或者参数已不存在(重试也没用)"""
+    return retries >= TASK_MAX_RETRIES or error.startswith(blob_util.BlobMissingError.__name__)
+
+
+def _apply_batch(task_name, items):
+    """
+    在任务池里执行一批消息(prefork 时运行在子进程，参数及返回值都需可 pickle)
+    :return: 与 items 等长的 list，None 表示成功，否则是失败原因
+    """
+    try:
+        return _run_batch(current_app.tasks[task_name], items)
+    except Exception as err:  # 出错也要返回结果，否则整批消息一直不 ack
+        logger.exception('批量执行任务出错: %s, 数量: %s, %s', task_name, len(items), err)
+        return [repr(err)] * len(items)
+
+
+def _run_batch(task, items):
+    """读取各条消息的参数，整批执行，返回各条的失败原因"""
+    errors = [None] * len(items)
+    batch, positions = [], []  # 参数读取成功的消息，及其在 items 中的位置
+    for i, (task_id, args, kwargs, retries) in enumerate(items):
+        try:
+            blob_key = blob_util.get_ref(args, kwargs)  # 参数存在外部存储
+            if blob_key:
+                args, kwargs = blob_util.load(blob_key)
+        except Exception as err:
+            logger.error('批量任务读取参数出错: %s:%s, %s', task.name, task_id, err)
+            errors[i] = repr(err)
+            continue
+        batch.append(BatchItem(task_id, args, kwargs, retries))
+        positions.append(i)
+    start_time = time.time()
+    if batch:
+        try:
+            results = task._run_fun(task.run, batch)
+        except Exception as err:
+            logger.exception('批量执行任务出错: %s, 数量: %s, %s', task.name, len(batch), err)
+            results = [err] * len(batch)
+        if results is None:
+            results = [None] * len(batch)
+        results = list(results)[:len(batch)]  # 返回的少了，其余的当作成功
+        for i, result in zip(positions, results):
+            errors[i] = repr(result) if isinstance(result, BaseException) else None
+    duration = (time.time() - start_time) / len(items)  # 每条消息分摊整批的耗时
+    for (task_id, args, kwargs, retries), error in zip(items, errors):
+        status = 'success' if error is None else 'failure' if _give_up(error, retries) else 'retry'
+        metrics_util.record(task.name, duration, status)  # 按条记录各自的执行结果
+        blob_key = blob_util.get_ref(args, kwargs)
+        # 成功了或者最后一次重试也失败了，外部存储的参数不再需要
+        if blob_key and (error is None or retries >= TASK_MAX_RETRIES):
+            blob_util.delete(blob_key)
+    return errors
+
+
+def batch_strategy(task, app, consumer, **kwargs):
+    """
+    BatchTask 的消息处理策略(替代 celery.worker.strategy:default)
+    收到的消息不直接交给任务池，而是先缓存起来，够数量或者到时间再整批提交
+    """
+    hostname = consumer.hostname
+    connection_errors = consumer.connection_errors
+    eventer = consumer.event_dispatcher
+    Req = create_request_cls(symbol_by_name(task.Request), task, consumer.pool, hostname, eventer, app=app)
+    revoked_tasks = consumer.controller.state.revoked
+    flush_every = max(int(task.flush_every), 1)
+    flush_interval = max(float(task.flush_interval), 1) / 1000.0
+    buffer = []
+    lock = threading.Lock()
+    timer = []  # 定时器，收到第一条消息时才启动(此时 timer 已可用)
+
+    def on_done(requests, errors):
+        """整批执行完毕，逐条 ack / 重试"""
+        if not isinstance(errors, list):  # 任务池执行失败(如子进程被杀)，得到的是 ExceptionInfo 或异常
+            errors = [repr(getattr(errors, 'exception', errors))] * len(requests)
+        for req, error in zip(requests, errors):
+            if error is not None:
+                retries = req.request_dict.get('retries') or 0
+                if not _give_up(error, retries):
+                    countdown = TASK_RETRY_DELAY ** (retries + 1)  # 延迟多久再重试
+                    logger.warning('批量任务出错，重试: %s:%s, 第%s次, 错误: %s', task.name, req.id, retries + 1, error)
+                    task.apply_async(req.args, req.kwargs, task_id=req.id, retries=retries + 1, countdown=countdown)
+                else:
+                    logger.error('批量任务出错，放弃重试: %s:%s, 参数: %s, 错误: %s',
+                                 task.name, req.id, (req.args, req.kwargs), error)
+            req.acknowledge()
+
+    def flush():
+        with lock:
+            requests = buffer[:]
+            del buffer[:]
+        if not requests:
+            return
+        logger.debug('批量执行任务: %s, 数量: %s', task.name, len(requests))
+        items = [(req.id, req.args, req.kwargs, req.request_dict.get('retries') or 0) for req in requests]
+        finished = []
+
+        def complete(errors):
+            """整批只处理一次(回调出错时，不会再按失败重复处理)"""
+            if not finished:
+                finished.append(True)
+                on_done(requests, errors)
+
+        try:
+            # error_callback: prefork 子进程被杀等，整批按失败处理(重试)，避免消息一直不 ack
+            consumer.pool.apply_async(_apply_batch, args=(task.name, items), callback=complete, error_callback=complete)
+        except Exception as exc:  # solo 等任务池在当前线程执行，出错直接抛出
+            logger.exception('批量任务提交到任务池出错: %s, 数量: %s', task.name, len(requests))
+            complete(exc)
+
+    def put(req):
+        if not timer:
+            timer.append(consumer.timer.call_repeatedly(flush_interval, flush))
+        with lock:
+            buffer.append(req)
+            full = len(buffer) >= flush_every
+        if full:
+            flush()
+
+    def apply_eta(req):
+        consumer.qos.decrement_eventually()
+        put(req)
+
+    def task_message_handler(message, body, ack, reject, callbacks, **kw):
+        if body is None and 'args' not in message.payload:
+            body, headers, decoded, utc = (message.body, message.headers, False, app.uses_utc_timezone())
+        elif 'args' in message.payload:
+            body, headers, decoded, utc = hybrid_to_proto2(message, message.payload)
+        else:
+            body, headers, decoded, utc = proto1_to_proto2(message, body)
+
+        req = Req(message, on_ack=ack, on_reject=reject, app=app, hostname=hostname,
+                  eventer=eventer, task=task, connection_errors=connection_errors,
+                  body=body, headers=headers, decoded=decoded, utc=utc)
+        if (req.expires or req.id in revoked_tasks) and req.revoked():
+            return
+
+        # 延迟执行的任务(delay 默认有 countdown)，到时间再放进缓存
+        if req.eta:
+            try:
+                if req.utc:
+                    eta = to_timestamp(timezone.to_system(req.eta))
+                else:
+                    eta = to_timestamp(req.eta, app.timezone)
+            except (OverflowError, ValueError) as exc:
+                logger.error('任务的 ETA 无法转换: %r, %r, 任务: %s:%s', req.eta, exc, task.name, req.id)
+                req.reject(requeue=False)
+                return
+            consumer.qos.increment_eventually()
+            consumer.timer.call_at(eta, apply_eta, (req,), priority=6)
+            return
+        put(req)
+
+    return task_message_handler
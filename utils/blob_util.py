@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+任务参数的外部存储(claim-check)
+任务参数过大时，存到本地目录或 redis，消息里只带引用 {'__blob__': key}，避免 broker 里的消息过大。
+worker 执行任务时再读取参数，任务执行成功或最终失败后删除。
+"""
+import os
+import mmap
+import uuid
+import logging
+
+from .bson_util import bson_dumps, bson_loads
+import settings
+
+logger = logging.getLogger(__name__)
+
+BLOB_KEY = '__blob__'  # 消息参数里的引用 key
+STORE = None  # 外部存储
+
+
+class BlobMissingError(Exception):
+    """外部存储的任务参数不存在(已过期、已删除或没有配置外部存储)，重试也没用"""
+
+
+class FileBlobStore(object):
+    """本地目录存储(多台机器需要共享此目录)"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, key, data):
+        file_path = self._file(key)
+        file_dir = os.path.dirname(file_path)
+        # 没有目录，则先创建目录，避免因此报错
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir, exist_ok=True)
+        # 先写临时文件再改名，避免读到写了一半的文件
+        tmp_file = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, file_path)
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m.read()
+        except FileNotFoundError:
+            raise BlobMissingError(f'任务参数不存在或已删除: {key}')
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class RedisBlobStore(object):
+    """redis 存储(带过期时间)"""
+
+    def __init__(self, url, prefix=None):
+        from .db_util import get_redis_client
+        self.conn = get_redis_client(url)
+        self.prefix = prefix or f'{settings.APP_NAME}:blob:'
+
+    def put(self, key, data):
+        self.conn.set(self.prefix + key, data, ex=settings.BLOB_TTL)
+
+    def get(self, key):
+        data = self.conn.get(self.prefix + key)
+        if data is None:
+            raise BlobMissingError(f'任务参数不存在或已过期: {key}')
+        return data
+
+    def delete(self, key):
+        self.conn.delete(self.prefix + key)
+
+
+def get_store():
+    """获取外部存储，没有配置则返回 None"""
+    global STORE
+    url = settings.BLOB_STORE_URL
+    if STORE is None and url:
+        if url.startswith(('redis://', 'rediss://')):
+            STORE = RedisBlobStore(url)
+        else:
+            STORE = FileBlobStore(url[len('file://'):] if url.startswith('file://') else url)
+    return STORE
+
+
+def _estimate_size(value, limit):
+    """
+    估算参数序列化后的大小(不真正序列化)，超过 limit 就不再往下算
+    只用于判断参数明显不大的，不需要序列化就可以直接发送
+    """
+    size = 0
+    stack = [value]
+    while stack and size <= limit:
+        value = stack.pop()
+        if isinstance(value, str):
+            size += len(value) + 2 if value.isascii() else len(value) * 6  # 非 ascii 字符转义成 \uXXXX
+        elif isinstance(value, (bytes, bytearray)):
+            size += len(value) * 2
+        elif isinstance(value, dict):
+            size += 2 + 4 * len(value)
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += 2 + 2 * len(value)
+            stack.extend(value)
+        else:  # 数值、时间、ObjectId 等
+            size += 64
+    return size
+
+
+def offload(args, kwargs):
+    """
+    任务参数过大时，存到外部存储，返回只带引用的参数
+    先估算大小，明显不大的不序列化(发送任务时 kombu 还会再序列化一次)
+    :return: (args, kwargs) 参数不大或者没有配置外部存储时，原样返回
+    """
+    store = get_store()
+    if store is None or (not args and not kwargs):
+        return args, kwargs
+    if _estimate_size((args, kwargs), settings.BLOB_THRESHOLD) < settings.BLOB_THRESHOLD:
+        return args, kwargs
+    data = bson_dumps({'args': args or [], 'kwargs': kwargs or {}}).encode('utf-8')
+    if len(data) < settings.BLOB_THRESHOLD:
+        return args, kwargs
+    key = uuid.uuid4().hex
+    store.put(key, data)
+    logger.debug('任务参数过大(%s字节)，存到外部存储: %s', len(data), key)
+    return (), {BLOB_KEY: key}
+
+
+def get_ref(args, kwargs):
+    """参数是外部存储的引用，则返回引用的 key，否则返回 None"""
+    if not args and kwargs and len(kwargs) == 1 and BLOB_KEY in kwargs:
+        return kwargs[BLOB_KEY]
+    return None
+
+
+def load(key):
+    """读取外部存储的任务参数，返回 (args, kwargs)，不存在则抛出 BlobMissingError"""
+    store = get_store()
+    if store is None:
+        raise BlobMissingError(f'没有配置外部存储(BLOB_STORE_URL)，无法读取任务参数: {key}')
+    data = bson_loads(store.get(key).decode('utf-8'))
+    return tuple(data.get('args') or ()), data.get('kwargs') or {}
+
+
+def delete(key):
+    """删除外部存储的任务参数"""
+    try:
+        get_store().delete(key)
+    except Exception as e:
+        logger.warning('删除外部存储的任务参数失败: %s, %s', key, e)
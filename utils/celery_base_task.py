@@ -5,9 +5,16 @@ import socket
 import logging
 import asyncio
 import inspect
+import itertools
+import concurrent.futures
 
-from celery import current_app, Task
+from celery import current_app, current_task, states, Task
+from celery.exceptions import TaskRevokedError, TimeLimitExceeded
+from celery.result import AsyncResult
+from celery.utils import uuid
 
+from . import blob_util, metrics_util, profile_util
+import settings
 
 logger = logging.getLogger(__name__)
 
@@ -15,13 +22,43 @@ TASK_TIMEOUT = float(os.environ.get('TASK_TIMEOUT') or 10)  # 异步任务执行
 TASK_MAX_RETRIES = int(os.environ.get('TASK_MAX_RETRIES') or 3)  # 任务重试次数
 TASK_RETRY_DELAY = int(os.environ.get('TASK_RETRY_DELAY') or 3)  # 任务重试时，延迟多久执行(单位:秒，每次指数增涨)
 TASK_COUNTDOWN = int(os.environ.get('TASK_COUNTDOWN') or 1)  # 异步任务，延迟多少秒执行
+# 队列堆积(任务数量超过 settings.QUEUE_LIMITS / LIMIT_TASK)时，抛出任务的处理策略，为空表示不处理：
+# block: 等待队列消化，超时则丢弃; shed: 直接丢弃; coalesce: 相同参数的任务合并为一个; divert: 转到溢出队列
+# 被丢弃的任务，apply_async/delay 返回 DroppedResult(dropped 为 True，状态为 REJECTED，get() 抛出 TaskRevokedError)
+BACKPRESSURE_POLICY = os.environ.get('BACKPRESSURE_POLICY') or ''
+BACKPRESSURE_TIMEOUT = float(os.environ.get('BACKPRESSURE_TIMEOUT') or 10)  # block 策略的等待时间、coalesce 策略的合并时间窗口(秒)
+
+
+class DroppedResult(AsyncResult):
+    """背压策略丢弃的任务的结果: 任务没有抛出到队列，不会执行"""
+    dropped = True
+
+    def __init__(self, id, task_name=None, **kwargs):
+        super().__init__(id, **kwargs)
+        self.task_name = task_name
+
+    def _get_task_meta(self):
+        return {'task_id': self.id, 'status': states.REJECTED, 'result': None, 'name': self.task_name}
+
+    def ready(self):
+        return True
+
+    def get(self, *args, **kwargs):
+        raise TaskRevokedError(f'任务被丢弃(队列堆积): {self.task_name}:{self.id}')
 
 
 class BaseTask(current_app.Task):
     max_retries = 3  # 最大重试次数
     default_retry_delay = 1  # 默认重试间隔(秒)
     event_loop = None  # 事件循环
+    shared_loop = None  # asyncio 任务池(utils.asyncio_pool)共享的事件循环，async 任务在上面并发执行
     tasks = {}  # 任务字典
+    backpressure = None  # 队列堆积时抛出任务的处理策略(block/shed/coalesce/divert)，不设置则使用 BACKPRESSURE_POLICY
+    backpressure_timeout = None  # block 策略的等待时间、coalesce 策略的合并时间窗口(秒)，不设置则使用 BACKPRESSURE_TIMEOUT
+    overflow_queue = None  # divert 策略的溢出队列，不设置则为 "原队列名_overflow" (需要有 worker 消费此队列)
+    stream_sink = None  # yield 生成器任务的流式输出位置(见 utils.stream_util)，不设置则把结果拼成 list 最后返回
+    stream_batch = 100  # 流式输出时，每批输出的数量
+    blob_offload = True  # 参数过大时存到外部存储(见 utils.blob_util)，消息里只带引用
 
     ''' 用到的再拿出来，没有用到的先注释掉
     def before_start(self, task_id, args, kwargs):
@@ -61,12 +98,108 @@ class BaseTask(current_app.Task):
         obj = cls()
         return obj.apply_async(args=args, kwargs=kwargs, countdown=TASK_COUNTDOWN)
 
+    def apply_async(self, args=None, kwargs=None, **options):
+        """
+        抛出任务，队列堆积时按背压策略处理(重试的任务不处理)
+        :return: AsyncResult；被丢弃的任务返回 DroppedResult(dropped 为 True)
+        """
+        policy = self.backpressure or BACKPRESSURE_POLICY
+        if policy and not options.get('retries'):
+            queue = options.get('queue') or getattr(self, 'queue', None) or self.app.conf.task_default_queue
+            queue = getattr(queue, 'name', queue)  # 也可能是 kombu.Queue
+            if self._is_overload(queue):
+                timeout = self.backpressure_timeout or BACKPRESSURE_TIMEOUT
+                if policy == 'block':
+                    deadline = time.time() + timeout
+                    while self._is_overload(queue) and time.time() < deadline:
+                        time.sleep(min(settings.QUEUE_SAMPLE_INTERVAL, max(deadline - time.time(), 0)))
+                    if self._is_overload(queue):
+                        policy = 'shed'  # 等待超时，丢弃
+                if policy == 'shed':
+                    logger.warning('队列%s任务堆积，丢弃任务:%s, 参数: %s', queue, self.name, (args, kwargs))
+                    return DroppedResult(options.get('task_id') or uuid(), task_name=self.name, app=self.app)
+                elif policy == 'coalesce':
+                    from .dedup_util import check_repeat, release_repeat
+                    options['task_id'] = options.get('task_id') or uuid()
+                    old_task_id = check_repeat(f'coalesce:{self.name}', args, kwargs, options['task_id'], timeout)
+                    if old_task_id:
+                        logger.info('队列%s任务堆积，合并到之前的任务:%s, %s', queue, self.name, old_task_id)
+                        return self.AsyncResult(old_task_id)
+                    try:
+                        return super().apply_async(args, kwargs, **options)
+                    except Exception:
+                        release_repeat(f'coalesce:{self.name}', args, kwargs, options['task_id'])  # 发送失败，不再合并到这个任务
+                        raise
+                elif policy == 'divert':
+                    options['queue'] = self.overflow_queue or f'{queue}_overflow'
+                    logger.info('队列%s任务堆积，任务转到溢出队列:%s, %s', queue, self.name, options['queue'])
+        return super().apply_async(args, kwargs, **options)
+
+    @staticmethod
+    def _is_overload(queue):
+        """队列是否堆积过多(读取队列深度采样的缓存)"""
+        from .queue_util import get_sampler
+        return get_sampler().get_depth(queue) >= settings.QUEUE_LIMITS.get(queue, settings.LIMIT_TASK)
+
+    @classmethod
+    def delay_many(cls, iterable_of_args, **options):
+        """
+        批量异步执行(共用一个 broker 连接，按批写入)
+        :param iterable_of_args: 每个元素是一次调用的位置参数(tuple/list)，不是 tuple/list 的则作为唯一的参数
+        :return: 惰性生成各任务 AsyncResult 的迭代器
+        """
+        calls = ((args if isinstance(args, (tuple, list)) else (args,), {}) for args in iterable_of_args)
+        options.setdefault('countdown', TASK_COUNTDOWN)
+        return cls.apply_many(calls, **options)
+
+    @classmethod
+    def apply_many(cls, iterable, batch=None, **options):
+        """
+        批量抛出任务(共用一个 producer 及连接，每批一次性写入 broker)
+        :param iterable: 每个元素是一次调用的 (args, kwargs)
+        :param batch: 每批写入的任务数量
+        :param options: apply_async 的其它参数，所有任务共用
+        :return: 惰性生成各任务 AsyncResult 的迭代器(被丢弃的任务没有)
+        """
+        from .celery_util import bulk_publish
+        obj = cls()
+        batch = batch or settings.BULK_SEND_BATCH
+        task_ids = []
+        iterator = iter(iterable)
+        with obj.app.producer_or_acquire() as producer:
+            while True:
+                calls = list(itertools.islice(iterator, batch))
+                if not calls:
+                    break
+                with bulk_publish(producer):
+                    for args, kwargs in calls:
+                        result = obj.apply_async(args, kwargs, producer=producer, **options)
+                        if not getattr(result, 'dropped', False):
+                            task_ids.append(result.id)
+        return (obj.AsyncResult(task_id) for task_id in task_ids)
+
     @classmethod
     def sync(cls, *args, **kwargs):
         """提供直接同步执行的静态函数"""
         obj = cls()
         return obj._run_fun(obj.run, *args, **kwargs)
 
+    @classmethod
+    def _run_on_shared_loop(cls, coro):
+        """在共享的事件循环上执行协程，等待结果(超过任务的时间限制则取消)"""
+        time_limit = cls.time_limit or current_app.conf.task_time_limit
+        from .asyncio_pool import in_task_greenlet, await_only
+        # 任务本身就在事件循环线程的 greenlet 里执行: 切回事件循环等待，不阻塞事件循环
+        if in_task_greenlet():
+            return await_only(coro, time_limit)
+        # 任务在线程里执行(判断不出是 async 的任务): 阻塞当前线程等待
+        future = asyncio.run_coroutine_threadsafe(coro, cls.shared_loop)
+        try:
+            return future.result(timeout=time_limit)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeLimitExceeded(time_limit)
+
     @classmethod
     def _run_fun(cls, fun, *args, **kwargs):
         """执行函数"""
@@ -76,12 +209,22 @@ class BaseTask(current_app.Task):
 
         # async 异步函数
         if inspect.iscoroutine(res):
+            # 使用 asyncio 任务池时，提交到共享的事件循环上，与其它任务的协程并发执行
+            if cls.shared_loop is not None and cls.shared_loop.is_running():
+                return cls._run_on_shared_loop(res)
             # return asyncio.run(res)
             loop = cls._get_event_loop()
             return loop.run_until_complete(res)
 
         # yield 生成器函数(途中各 yield 语句返回的值会被拼接到一起，最后以 list 形式一起返回)
         if inspect.isgenerator(res):
+            # 流式输出: 逐批写到 stream_sink，只返回汇总信息
+            if cls.stream_sink:
+                from .stream_util import stream_results
+                request = current_task.request if current_task else None
+                task_id = getattr(request, 'id', None)
+                return stream_results(res, cls.stream_sink, cls.name, task_id or uuid(), batch=cls.stream_batch,
+                                      retries=getattr(request, 'retries', 0) or 0)
             results = []
             while True:
                 try:
@@ -99,11 +242,28 @@ class BaseTask(current_app.Task):
         logger.debug(f'BaseTask task __call__ args: {args}, kwargs:{kwargs}')
         start_time = time.time()
         task_name = self.__module__ or self.name
+        blob_key = blob_util.get_ref(args, kwargs)  # 参数存在外部存储
+        status = 'success'  # 执行结果，记录到耗时统计
+        profiler = profile_util.start(self.name)  # 抽样做性能分析
         try:
+            if blob_key:
+                args, kwargs = blob_util.load(blob_key)
             # return super().__call__(*args, **kwargs)
-            return self._run_fun(super().__call__, *args, **kwargs)
+            result = self._run_fun(super().__call__, *args, **kwargs)
+            if blob_key:
+                blob_util.delete(blob_key)
+            return result
+        except blob_util.BlobMissingError as err:
+            # 参数已不存在，重试也没用，直接失败
+            status = 'failure'
+            logger.error('执行任务出错，任务参数不存在: %s:%s, %s', task_name, self.request.id, err)
+            raise
         except Exception as err:
             retries = self.request.retries
+            status = 'failure' if retries >= TASK_MAX_RETRIES else 'retry'
+            # 最后一次重试也失败了，外部存储的参数不再需要
+            if blob_key and retries >= TASK_MAX_RETRIES:
+                blob_util.delete(blob_key)
             countdown = TASK_RETRY_DELAY ** (retries + 1)  # 延迟多久再重试
             # 请求超时,登录异常,不记录error日志
             if isinstance(err, (socket.timeout, TimeoutError,
@@ -115,19 +275,26 @@ class BaseTask(current_app.Task):
         finally:
             # 超时日志
             duration = time.time() - start_time
+            metrics_util.record(self.name, duration, status)
             _args = args[1:] if self else args
+            if profiler is not None:
+                profile_util.finish(profiler, self.name, duration, TASK_TIMEOUT, self.request.id, (_args, kwargs))
             if duration >= TASK_TIMEOUT:  # 耗时太长
                 logger.warning('任务耗时太长:%.4f秒, task:%s, 参数: %s', duration, task_name, (_args, kwargs))
             else:
                 logger.debug('执行任务耗时:%.4f秒, task:%s, 参数: %s', duration, task_name, (_args, kwargs))
 
     @classmethod
-    def send_pulsar(cls, *args, user_id=None, company_id=None, queue=None, priority=0, **kwargs):
-        """发送消息到 pulsar 队列"""
+    def send_pulsar(cls, *args, user_id=None, company_id=None, queue=None, priority=0, pulsar_sync=True, **kwargs):
+        """
+        发送消息到 pulsar 队列
+        默认同步发送，返回 MessageId；pulsar_sync=False 时异步批量发送，返回 Future(见 pulsar_util.send_message)
+        """
         from .pulsar_util import send_message
         obj = cls()
+        args, kwargs = blob_util.offload(args, kwargs)  # 参数过大的，存到外部存储，消息里只带引用
         return send_message(task_name=obj.name, args=args, kwargs=kwargs, user_id=user_id, company_id=company_id,
-                            queue=queue or obj.queue, priority=priority or obj.priority)
+                            queue=queue or obj.queue, priority=priority or obj.priority, sync=pulsar_sync)
 
 
 
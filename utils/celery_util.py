@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 import os
+import re
+import time
+import zlib
 import socket
+import hashlib
 import logging
 import inspect
+from contextlib import contextmanager
 
 from celery import Celery
 from celery import current_app, Task
+from celery.utils import uuid
+from kombu import Connection, Producer, Queue
+from kombu.compression import compress, register as register_compression
 from kombu.serialization import register
 
 from .import_util import import_submodules
-from .str_util import base64_decode, decode2str
+from .str_util import zlib_encode
 from .json_util import load_json
 from .db_util import get_mongo_db, get_redis_client
 from .bson_util import bson_dumps, bson_loads
+from .msgpack_util import msgpack, msgpack_dumps, msgpack_loads
+from . import dedup_util, blob_util
 import settings
 
 # 定时任务配置
@@ -23,14 +33,37 @@ PID = os.getpid()  # 当前进程ID
 
 # 注册 celery 的 json 序列化
 register('json', bson_dumps, bson_loads, content_type='application/json', content_encoding='utf-8')
+# 注册 celery 的 msgpack 序列化(二进制，更小更快，需安装 msgpack)，使用: CELERY_TASK_SERIALIZER=msgpack
+if msgpack is not None:
+    register('msgpack', msgpack_dumps, msgpack_loads, content_type='application/x-msgpack', content_encoding='binary')
 
 logger = logging.getLogger(__name__)
 
 
-def custom_send_task(self, *args, **kwargs):
+def custom_send_task(self, name, args=None, kwargs=None, **options):
     """celery 发任务补丁,beat及worker抛出任务前都经过它(如果worker一直不抛出任务，则不会调用)"""
-    logger.debug(f'celery.Celery.send_task args:{args}, kwargs:{kwargs}')
-    return self._old_send_task(*args, **kwargs)
+    logger.debug(f'celery.Celery.send_task name:{name}, args:{args}, kwargs:{kwargs}, options:{options}')
+    # 去重: 时间窗口内重复抛出的任务(重试的除外)，合并到之前抛出的任务上
+    task = self.tasks.get(name)
+    window = getattr(task, 'dedup_window', None)
+    window = settings.SEND_TASK_DEDUP_WINDOW if window is None else window
+    dedup = bool(window and not options.get('retries'))
+    if dedup:
+        options['task_id'] = options.get('task_id') or uuid()
+        old_task_id = dedup_util.check_repeat(name, args, kwargs, options['task_id'], window)
+        if old_task_id:
+            logger.info('任务重复抛出，合并到之前的任务:%s, %s', name, old_task_id)
+            result_cls = options.get('result_cls') or self.AsyncResult
+            return result_cls(old_task_id)
+    try:
+        # 参数过大的，存到外部存储，消息里只带引用(只有本项目的 BaseTask 任务能读取引用，外部/未注册的任务不处理)
+        send_args, send_kwargs = blob_util.offload(args, kwargs) if getattr(task, 'blob_offload', False) else (args, kwargs)
+        return self._old_send_task(name, send_args, send_kwargs, **options)
+    except Exception:
+        # 发送失败，删除去重记录，否则时间窗口内重新发送都会被当作重复
+        if dedup:
+            dedup_util.release_repeat(name, args, kwargs, options['task_id'])
+        raise
 
 
 # 打补丁的方式来监控 beat 和 worker，虽然比较难看，但 flower 那种使用线程不断轮询的方式也不见得好多少。
@@ -40,6 +73,24 @@ if not hasattr(Celery, '_old_send_task'):
     setattr(Celery, '_old_send_task', _old_send_task)
     setattr(Celery, 'send_task', custom_send_task)
 
+
+def custom_prepare(self, body, serializer=None, content_type=None, content_encoding=None, compression=None,
+                   headers=None):
+    """kombu 序列化消息补丁，只压缩超过 COMPRESSION_THRESHOLD 的消息(小消息压缩没有收益，也不加压缩标记)"""
+    body, content_type, content_encoding = self._old_prepare(body, serializer, content_type, content_encoding,
+                                                             None, headers)
+    if compression and len(body) >= settings.COMPRESSION_THRESHOLD:
+        body, headers['compression'] = compress(body, compression)
+    return body, content_type, content_encoding
+
+
+# 使用快速的压缩级别重新注册 zlib 压缩(消息头的 compression 标记不变，各版本的 worker 都能解压)
+register_compression(lambda body: zlib_encode(body, level=settings.COMPRESSION_LEVEL), zlib.decompress,
+                     'application/x-gzip', aliases=['gzip', 'zlib'])
+if not hasattr(Producer, '_old_prepare'):
+    setattr(Producer, '_old_prepare', getattr(Producer, '_prepare'))
+    setattr(Producer, '_prepare', custom_prepare)
+
 '''
 from celery.task import Task
 
@@ -56,9 +107,71 @@ setattr(Task, '_Task__call__', custom_task_call)
 '''
 
 
+class _BulkCollection(object):
+    """代替 mongodb 的 messages 集合，insert_one 先缓存起来，最后一次 insert_many"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.documents = []
+
+    def insert_one(self, document, *args, **kwargs):
+        self.documents.append(document)
+
+    def flush(self):
+        if self.documents:
+            self.collection.insert_many(self.documents, ordered=True)
+            self.documents = []
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+@contextmanager
+def bulk_publish(producer):
+    """
+    批量发送消息，退出时才一次性写入 broker:
+    redis 使用 pipeline，mongodb 使用 insert_many，sqlalchemy(sqlite 等)使用同一个事务。其它 broker 则逐条发送。
+    :param producer: kombu producer，期间通过它发送的消息都会批量写入
+    """
+    channel = producer.channel
+    driver_type = producer.connection.transport.driver_type
+    if driver_type == 'redis':
+        pipe = channel._create_client().pipeline(transaction=False)
+
+        @contextmanager
+        def conn_or_acquire(client=None):
+            yield client or pipe
+
+        channel.conn_or_acquire = conn_or_acquire
+        try:
+            yield
+        finally:
+            del channel.conn_or_acquire
+            pipe.execute()
+    elif driver_type == 'mongodb':
+        collection = channel.messages
+        channel.messages = _BulkCollection(collection)
+        try:
+            yield
+        finally:
+            bulk, channel.messages = channel.messages, collection
+            bulk.flush()
+    elif driver_type == 'sql':
+        session = channel.session
+        session.commit = lambda: None  # 期间不提交，最后一起提交
+        try:
+            yield
+        finally:
+            del session.commit
+            session.commit()
+    else:
+        yield
+
+
 def load_task(path, app=None):
     """
     load class tasks
+    配置了 settings.TASK_MANIFEST 时，使用任务清单注册轻量的代理任务，收到任务时才 import 任务所在的模块(见 manifest_util)
     """
     global BEAT_SCHEDULE
     # 重新赋予基类，必须在task注册之前，才可以使task继承基类
@@ -67,176 +180,486 @@ def load_task(path, app=None):
     app.Task = BaseTask
     tasks = BaseTask.tasks
 
-    task_classes = lambda x: inspect.isclass(x) and x != Task and x != BaseTask and issubclass(x, Task)
-    task_processors = lambda x: isinstance(x, Task)
+    if settings.TASK_MANIFEST:
+        from . import manifest_util
+        manifest = manifest_util.read_manifest(settings.TASK_MANIFEST, path)
+        if manifest is not None:
+            BEAT_SCHEDULE.update(manifest_util.register_lazy_tasks(manifest, app))
+            app.conf.beat_schedule = BEAT_SCHEDULE
+            logger.info(f'BEAT_SCHEDULE:{BEAT_SCHEDULE}')
+            return tasks
+
     modules = import_submodules(path)
+    entries = []
     for k, _cls in modules.items():
-        # 使用 @celery.task 装饰器的异步任务函数
-        for _name, _task_func in inspect.getmembers(_cls, task_processors):
-            task_name = _task_func.name
-            logger.info('Loading Task (PRC): %s %s', k, task_name)
-            app.register_task(_task_func)
-            tasks[task_name] = _task_func
-            if hasattr(_task_func, 'schedule') and getattr(_task_func, 'schedule', None):
-                BEAT_SCHEDULE[task_name] = {
-                    'task': task_name,
-                    'schedule': getattr(_task_func, 'schedule', None)
-                }
-                _task_func.schedule = None  # 去掉 schedule 属性，避免重复执行
-                # delattr(_task_func, 'schedule')
-        # 继承 CeleryTask 类写法的异步任务类
-        for _name, _task_cls in inspect.getmembers(_cls, task_classes):
-            task_name = _task_cls.name
-            logger.info('Loading Task (CLS): %s %s', _name, task_name)
-            _task = _task_cls()
-            app.register_task(_task)
-            tasks[task_name] = _task
-            if hasattr(_task_cls, 'schedule') and getattr(_task_cls, 'schedule', None):
-                BEAT_SCHEDULE[task_name] = {
-                    'task': task_name,
-                    'schedule': getattr(_task_cls, 'schedule', None)
-                }
-                delattr(_task_cls, 'schedule')  # 去掉 schedule 属性，避免重复执行
+        entries.extend(register_module_tasks(_cls, app))
+    for entry in entries:
+        if entry['schedule']:
+            BEAT_SCHEDULE[entry['name']] = {
+                'task': entry['name'],
+                'schedule': entry['schedule']
+            }
     app.conf.beat_schedule = BEAT_SCHEDULE
     logger.info(f'BEAT_SCHEDULE:{BEAT_SCHEDULE}')
+    if settings.TASK_MANIFEST:
+        from . import manifest_util
+        manifest_util.write_manifest(settings.TASK_MANIFEST, path, entries)
     return tasks
 
 
+def register_module_tasks(module, app=None):
+    """
+    注册一个模块里的任务
+    :return: 注册的任务信息 [{'name': 任务名, 'task': 任务, 'schedule': 定时配置}]
+    """
+    from .celery_base_task import BaseTask
+    from .batch_task import BatchTask
+    app = app or current_app
+    tasks = BaseTask.tasks
+    entries = []
+
+    task_classes = lambda x: inspect.isclass(x) and x not in (Task, BaseTask, BatchTask) and issubclass(x, Task)
+    task_processors = lambda x: isinstance(x, Task)
+    # 使用 @celery.task 装饰器的异步任务函数
+    for _name, _task_func in inspect.getmembers(module, task_processors):
+        task_name = _task_func.name
+        logger.info('Loading Task (PRC): %s %s', module.__name__, task_name)
+        app.register_task(_task_func)
+        tasks[task_name] = _task_func
+        schedule = getattr(_task_func, 'schedule', None)
+        if schedule:
+            _task_func.schedule = None  # 去掉 schedule 属性，避免重复执行
+            # delattr(_task_func, 'schedule')
+        entries.append({'name': task_name, 'task': _task_func, 'schedule': schedule})
+    # 继承 CeleryTask 类写法的异步任务类
+    for _name, _task_cls in inspect.getmembers(module, task_classes):
+        task_name = _task_cls.name
+        logger.info('Loading Task (CLS): %s %s', _name, task_name)
+        _task = _task_cls()
+        app.register_task(_task)
+        tasks[task_name] = _task
+        schedule = getattr(_task_cls, 'schedule', None)
+        if schedule:
+            delattr(_task_cls, 'schedule')  # 去掉 schedule 属性，避免重复执行
+        entries.append({'name': task_name, 'task': _task, 'schedule': schedule})
+    return entries
+
+
 def delete_repeat_task():
     """删除重复的任务(任务可能太久没执行完，从而再次抛出导致重复)"""
     broker_url = settings.CELERY_CONFIG.broker_url
     queues = settings.ALL_QUEUES
     limit_tasks = settings.LIMIT_TASK
+    stats = []  # 各队列的处理统计
 
     if broker_url.startswith('mongodb://'):
         db = get_mongo_db(broker_url)
         for key in queues:
-            size = db.messages.find({"queue": key}).count()
+            size = db.messages.count_documents({"queue": key})
             # 任务数量不多的情况下，认为没有堆积
-            if size < limit_tasks:
+            if size < settings.QUEUE_LIMITS.get(key, limit_tasks):
                 continue
             else:
-                delete_mongodb_repeat_task(db, key, size)
+                stats.append(delete_mongodb_repeat_task(db, key, size))
     elif broker_url.startswith('redis://'):
         conn = get_redis_client(broker_url)
         for key in queues:
             size = conn.llen(key)
             # 任务数量不多的情况下，认为没有堆积
-            if size < limit_tasks:
+            if size < settings.QUEUE_LIMITS.get(key, limit_tasks):
                 continue
             else:
-                delete_redis_repeat_task(conn, key, size)
+                stats.append(delete_redis_repeat_task(conn, key, size))
     # 使用 RabbitMQ
     elif broker_url.startswith(('amqp://', 'pyamqp://', 'rpc://')):
-        pass  # todo: 未实现
+        with get_kombu_connection(broker_url) as conn:
+            for key in queues:
+                size = get_kombu_queue_size(conn, key)
+                # 任务数量不多的情况下，认为没有堆积
+                if size < settings.QUEUE_LIMITS.get(key, limit_tasks):
+                    continue
+                else:
+                    stats.append(delete_kombu_repeat_task(conn, key, size))
+    return stats
 
 
 def clear_tasks():
-    """清除所有任务"""
+    """
+    清除各队列(settings.ALL_QUEUES)的旧任务
+    只删除 celery 队列相关的数据，不影响同一个库里的其它数据(任务结果、锁等)；
+    加锁保证同一次部署只清除一次，而不是每个进程启动都清除
+    :return: 清除统计，没有清除(锁已被占用、连接不上或不支持的 broker)则返回 None
+    """
     broker_url = settings.CELERY_CONFIG.broker_url
+    queues = settings.ALL_QUEUES
+    lock_key = f'{settings.APP_NAME}:clear_tasks:{settings.DEPLOY_ID}'
     if broker_url.startswith('mongodb://'):
         db = get_mongo_db(broker_url)
-        db.messages.remove({})
+        if db is None:
+            logger.error('mongodb 连接不上，不清除旧任务: %s', broker_url)
+            return None
+        locked = acquire_mongodb_lock(db, lock_key, settings.CLEAR_TASKS_LOCK_TTL)
+        stats = purge_mongodb_queues(db, queues) if locked else None
     elif broker_url.startswith('redis://'):
         conn = get_redis_client(broker_url)
-        conn.flushdb()
-    # 使用 RabbitMQ
+        locked = conn.set(lock_key, f'{HOST_NAME}:{PID}', nx=True, ex=settings.CLEAR_TASKS_LOCK_TTL)
+        stats = purge_redis_queues(conn, queues) if locked else None
+    # 使用 RabbitMQ: broker 上没法加锁，锁放在 redis/mongodb 的结果存储上；没有这样的结果存储则不清除(每个进程启动都清除会清掉正在使用的队列)
     elif broker_url.startswith(('amqp://', 'pyamqp://', 'rpc://')):
-        pass  # todo: 未实现
+        locked = acquire_backend_lock(lock_key, settings.CLEAR_TASKS_LOCK_TTL)
+        if locked is None:
+            logger.warning('RabbitMQ 需要 redis/mongodb 的结果存储加锁保证只清除一次，不清除旧任务')
+            return None
+        if locked:
+            with get_kombu_connection(broker_url) as conn:
+                stats = purge_kombu_queues(conn, queues)
+        else:
+            stats = None
+    else:
+        logger.warning('不支持的 broker，不清除旧任务: %s', broker_url.split('://', 1)[0])
+        return None
+    if stats is None:
+        logger.info('其它进程已清除过旧任务，跳过: %s', lock_key)
+    else:
+        logger.warning('清除旧任务: %s', stats)
+    return stats
+
+
+def _transport_option(name, default):
+    """broker 的 transport_options 配置(redis 的 unacked 等 key 名称可以自定义)"""
+    options = getattr(settings.CELERY_CONFIG, 'broker_transport_options', None) or {}
+    return options.get(name, default)
+
+
+def purge_redis_queues(conn, queues, batch=None):
+    """
+    清除 redis 里指定队列的任务，不影响其它 key(不使用 flushdb)
+    1. SCAN 找出队列的 key、优先级队列的 key(队列名 + '\\x06\\x16' + 优先级)及删除重复任务的临时队列，按批 UNLINK(后台释放内存，不阻塞)
+    2. HSCAN 未确认的消息(unacked)，按批删除属于这些队列的
+    :return: 清除统计 {'keys': 删除的 key 数量, 'unacked': 删除的未确认消息数量, 'seconds': 耗时}
+    """
+    batch = batch or settings.PURGE_BATCH
+    start_time = time.time()
+    sep = _transport_option('sep', '\x06\x16')
+    queues = {q.encode('utf-8') if isinstance(q, str) else q for q in queues}
+    sep = sep.encode('utf-8')
+    keys = []
+    for queue in queues:
+        # 队列名里的通配符需要转义
+        pattern = re.sub(rb'([*?\[\]\\])', rb'\\\1', queue) + b'*'
+        for key in conn.scan_iter(match=pattern, count=batch):
+            if key == queue or key.startswith(queue + sep) or key == queue + b':dedup':
+                keys.append(key)
+    deleted = 0
+    for i in range(0, len(keys), batch):
+        chunk = keys[i:i + batch]
+        try:
+            deleted += conn.unlink(*chunk)
+        except Exception:  # redis 4.0 以下没有 UNLINK
+            deleted += conn.delete(*chunk)
+
+    # 未确认的消息: {delivery_tag: json([message, exchange, routing_key])}
+    unacked_key = _transport_option('unacked_key', 'unacked')
+    unacked_index_key = _transport_option('unacked_index_key', 'unacked_index')
+    tags = []
+    for tag, value in conn.hscan_iter(unacked_key, count=batch):
+        item = load_json(value)
+        if isinstance(item, list) and len(item) >= 3 and str(item[2]).encode('utf-8') in queues:
+            tags.append(tag)
+    for i in range(0, len(tags), batch):
+        chunk = tags[i:i + batch]
+        pipe = conn.pipeline(transaction=False)
+        pipe.hdel(unacked_key, *chunk)
+        pipe.zrem(unacked_index_key, *chunk)
+        pipe.execute()
+    return {'keys': deleted, 'unacked': len(tags), 'seconds': round(time.time() - start_time, 4)}
+
+
+def purge_mongodb_queues(db, queues):
+    """
+    清除 mongodb 里指定队列的任务(只删除这些队列的消息，走 queue 索引)
+    :return: 清除统计 {'messages': 删除的消息数量, 'seconds': 耗时}
+    """
+    start_time = time.time()
+    result = db.messages.delete_many({'queue': {'$in': list(queues)}})
+    return {'messages': result.deleted_count, 'seconds': round(time.time() - start_time, 4)}
+
+
+def acquire_mongodb_lock(db, key, ttl):
+    """
+    mongodb 实现的锁(唯一 _id 插入，过期时间由 TTL 索引清理)
+    :return: 是否拿到锁
+    """
+    from pymongo.errors import DuplicateKeyError
+    from datetime import datetime, timedelta
+    collection = db.locks
+    collection.create_index('expire_at', expireAfterSeconds=0)
+    now = datetime.utcnow()
+    doc = {'_id': key, 'owner': f'{HOST_NAME}:{PID}', 'expire_at': now + timedelta(seconds=ttl)}
+    try:
+        collection.insert_one(doc)
+        return True
+    except DuplicateKeyError:
+        # TTL 索引每分钟才清理一次，已过期但还没被清理的锁可以直接抢占
+        return collection.find_one_and_replace({'_id': key, 'expire_at': {'$lt': now}}, doc) is not None
+
+
+def acquire_backend_lock(key, ttl):
+    """
+    在结果存储(redis/mongodb)上加锁，用于 broker 本身没法加锁的情况(RabbitMQ)
+    :return: 是否拿到锁，结果存储不是 redis/mongodb(或连不上)则返回 None
+    """
+    backend_url = settings.CELERY_CONFIG.result_backend or ''
+    if backend_url.startswith('redis://'):
+        return bool(get_redis_client(backend_url).set(key, f'{HOST_NAME}:{PID}', nx=True, ex=ttl))
+    if backend_url.startswith('mongodb://'):
+        db = get_mongo_db(backend_url)
+        return acquire_mongodb_lock(db, key, ttl) if db is not None else None
+    return None
+
+
+def get_kombu_connection(broker_url):
+    """获取 kombu 连接(RabbitMQ 开启 publisher confirms，放回队列的任务确认写入后才删除原任务)"""
+    if broker_url.startswith('rpc://'):
+        broker_url = 'amqp://' + broker_url[len('rpc://'):]
+    return Connection(broker_url, transport_options={'confirm_publish': True})
+
+
+def get_kombu_queue_size(conn, queue):
+    """获取 kombu 队列的任务数量(队列不存在则返回 0)"""
+    try:
+        with conn.channel() as channel:
+            return channel.queue_declare(queue, passive=True).message_count
+    except conn.channel_errors as e:
+        logger.debug('获取队列%s信息失败:%s', queue, e)
+        return 0
+
+
+def purge_kombu_queues(conn, queues):
+    """
+    清空 kombu 的指定队列(只清空本项目的队列，不影响 broker 上的其它队列)
+    :return: 清除统计 {'messages': 清除的任务数量, 'seconds': 耗时}
+    """
+    start_time = time.time()
+    total = 0
+    for key in queues:
+        try:
+            with conn.channel() as channel:
+                count = channel.queue_purge(key) or 0
+            total += count
+            logger.info('清空队列:%s, 任务数量:%s', key, count)
+        except conn.channel_errors as e:
+            logger.warning('清空队列%s失败:%s', key, e)
+    return {'messages': total, 'seconds': round(time.time() - start_time, 4)}
+
+
+def delete_kombu_repeat_task(conn, queue, total, batch=None, rate=None):
+    """删除指定queue的重复任务(RabbitMQ，也适用于 kombu 的 memory 等虚拟传输)
+    按批次 basic_get 取出任务，不重复的任务重新发布到队列后面，发布确认后才 ack 原任务，重复的直接 ack 丢弃。
+    :param conn: 作为celery broker的 kombu 连接
+    :param queue: queue 名称
+    :param total: 积累的任务数量(最多处理这么多，避免处理到放回去的任务)
+    :param batch: 每批处理的任务数量
+    :param rate: 每秒最多处理的任务数量，0 表示不限速
+    :return: 处理统计 {'queue': 队列名, 'scanned': 扫描数量, 'removed': 删除数量, 'seconds': 耗时}
+    """
+    batch = batch or settings.REPEAT_TASK_BATCH
+    rate = settings.REPEAT_TASK_RATE if rate is None else rate
+    start_time = time.time()
+    digest_set = set()
+    scanned = removed = 0
+    with conn.channel() as channel:
+        task_queue = Queue(queue, channel=channel, no_declare=True)
+        producer = Producer(channel, routing_key=queue)
+        while scanned < total:
+            batch_time = time.time()
+            messages = []
+            for _ in range(min(batch, total - scanned)):
+                message = task_queue.get(no_ack=False)
+                # 没有数据了
+                if message is None:
+                    break
+                messages.append(message)
+            if not messages:
+                break
+            scanned += len(messages)
+            for message in messages:
+                digest = _body_digest(message.body)
+                # 参数完全相同的，认为是重复子任务。
+                if digest is not None and digest in digest_set:
+                    removed += 1
+                    logger.debug('删除重复任务:%s', message.headers)
+                else:
+                    digest_set.add(digest)
+                    properties = message.properties
+                    producer.publish(message.body, routing_key=queue, headers=message.headers,
+                                     content_type=message.content_type, content_encoding=message.content_encoding,
+                                     priority=properties.get('priority') or 0,
+                                     delivery_mode=properties.get('delivery_mode'),
+                                     correlation_id=properties.get('correlation_id'),
+                                     reply_to=properties.get('reply_to'))
+                message.ack()
+            # 限速，避免长时间占用 broker 影响正常消费
+            if rate:
+                wait = len(messages) / rate - (time.time() - batch_time)
+                if wait > 0:
+                    time.sleep(wait)
+    stats = {'queue': queue, 'scanned': scanned, 'removed': removed, 'seconds': round(time.time() - start_time, 4)}
+    logger.warning('删除重复任务: %s', stats)
+    return stats
+
+
+def _body_digest(body):
+    """
+    计算任务 body 的定长摘要(只保存摘要而不是整个 body，避免任务堆积很多时占用大量内存)
+    body 为空(消息格式不对)的返回 None，这些任务无法判断是否重复，总是保留
+    """
+    if not body:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.blake2b(body, digest_size=16).digest()
 
 
-def delete_redis_repeat_task(conn, queue, total):
+# 从队列左边取出一批任务，原子地移到临时队列(处理中的任务总在 redis 里，进程崩溃也不会丢)
+# lua 的 unpack 参数数量有上限(约 8000)，每次 RPUSH 1000 条
+_REDIS_MOVE_BATCH = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+    end
+end
+return items
+"""
+# 临时队列里残留的任务(上次处理中途出错)放回队列后面
+_REDIS_RESTORE = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+if #items > 0 then
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', KEYS[1], unpack(items, i, math.min(i + 999, #items)))
+    end
+    redis.call('DEL', KEYS[2])
+end
+return #items
+"""
+
+
+def delete_redis_repeat_task(conn, queue, total, batch=None):
     """删除指定queue的重复任务
+    按批次从队列左边取出任务，用 lua 脚本原子地移到临时队列(queue + ':dedup')；
+    不重复的任务 rpush 放回队列后面并删除临时队列(同一个事务)，每批只需要两次交互。
+    任务始终在 redis 里(队列或临时队列)，中途出错的话，下次处理前先把临时队列的任务放回去。
+    判断重复只保存 body 的定长摘要。
     :param conn: 作为celery broker的 redis 数据库连接
     :param queue: queue 名称
     :param total: 积累的任务数量
+    :param batch: 每批处理的任务数量
+    :return: 处理统计 {'queue': 队列名, 'scanned': 扫描数量, 'removed': 删除数量, 'seconds': 耗时}
     """
-    param_set = set()
-    for index in range(total):
-        res = conn.lpop(queue)
+    batch = batch or settings.REPEAT_TASK_BATCH
+    start_time = time.time()
+    digest_set = set()
+    scanned = removed = 0
+    temp_key = f'{queue}:dedup'
+    move_batch = conn.register_script(_REDIS_MOVE_BATCH)
+    restored = conn.register_script(_REDIS_RESTORE)(keys=[queue, temp_key])
+    if restored:
+        logger.warning('上次删除重复任务中途出错，放回队列:%s, 任务数量:%s', queue, restored)
+    while scanned < total:
+        size = min(batch, total - scanned)
+        items = move_batch(keys=[queue, temp_key], args=[size])
         # 没有数据了
-        if res is None:
+        if not items:
             break
-        # conn.lindex(key, index)
-        result = load_json(res)
-        body = base64_decode(result.get("body"))
-        # 参数完全相同的，认为是重复子任务。
-        if body in param_set:
-            logger.warning('删除重复任务:%s, %s', body, res)
-            continue
-        # 不重复的任务，放回队列后面
-        else:
-            param_set.add(body)
-            conn.rpush(queue, res)
-        del body
-        del res
-        del result
-    del param_set
+        scanned += len(items)
+        keep = []
+        for res in items:
+            result = load_json(res) or {}
+            digest = _body_digest(result.get("body") if isinstance(result, dict) else None)
+            # 参数完全相同的，认为是重复子任务。
+            if digest is not None and digest in digest_set:
+                removed += 1
+                logger.debug('删除重复任务:%s', res)
+                continue
+            digest_set.add(digest)
+            keep.append(res)
+        # 不重复的任务放回队列后面，并删除临时队列
+        pipe = conn.pipeline(transaction=True)
+        if keep:
+            pipe.rpush(queue, *keep)
+        pipe.delete(temp_key)
+        pipe.execute()
+    stats = {'queue': queue, 'scanned': scanned, 'removed': removed, 'seconds': round(time.time() - start_time, 4)}
+    logger.warning('删除重复任务: %s', stats)
+    return stats
 
 
-def delete_mongodb_repeat_task(db, queue, total):
+def delete_mongodb_repeat_task(db, queue, total, batch=None):
     """删除指定queue的重复任务
+    1. 给还没有摘要的任务批量补算 body 摘要(digest 字段)
+    2. 用一次聚合查询按 (queue, digest) 分组，找出重复的摘要
+    3. 每组只保留最新的一条，其余的批量删除(走 (queue, digest) 索引)
     :param db: 作为celery broker的 mongodb 数据库连接
     :param queue: queue 名称
     :param total: 积累的任务数量
+    :param batch: 每批写入的数量
+    :return: 处理统计 {'queue': 队列名, 'scanned': 聚合查询处理的任务数量(有摘要的), 'digested': 补算摘要的数量,
+                      'removed': 删除数量, 'seconds': 耗时}
     """
-    param_set = set()
-    limit = 100  # 每次处理的数量
-    page = (total + limit - 1) // limit  # 共需分多少批次(分页算法的页数)
-    # 分批执行。这里使用倒序页码，是为了避免正序时删除前面的导致后面分页改变
-    for page_index in range(page, -1, -1):
-        start_index = page_index * limit
-        queue_tasks = db.messages.find({"queue": queue}).skip(start_index).limit(limit)
-        delete_ids = set()
-        for d in queue_tasks:
-            payload = d.get('payload')
-            result = load_json(payload)
-            body = base64_decode(result.get("body"))
-            # 参数完全相同的，认为是重复子任务。
-            if body in param_set:
-                logger.warning('删除重复子任务:%s, %s', body, payload)
-                delete_ids.add(d.get("_id"))
-        if delete_ids:
-            db.messages.remove({"queue": queue, "_id": {'$in': list(delete_ids)}})
+    from pymongo import UpdateOne, DeleteMany
+    batch = batch or settings.REPEAT_TASK_BATCH
+    start_time = time.time()
+    collection = db.messages
+    collection.create_index([('queue', 1), ('digest', 1)], background=True)
 
+    # 补算摘要。只取 payload 字段，按 _id 顺序一次遍历
+    scanned = 0
+    updates = []
+    cursor = collection.find({'queue': queue, 'digest': {'$exists': False}}, {'payload': 1}).batch_size(batch)
+    for d in cursor:
+        scanned += 1
+        result = load_json(d.get('payload')) or {}
+        digest = _body_digest(result.get("body") if isinstance(result, dict) else None)
+        updates.append(UpdateOne({'_id': d['_id']}, {'$set': {'digest': digest}}))
+        if len(updates) >= batch:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
 
-def get_pending_msg():
-    """获取正在准备执行的worker任务数量"""
-    from ..main import celery_app as app
-    total_msg = 0  # 总任务数
-    queues = settings.ALL_QUEUES
-    messages = {key: 0 for key in queues}  # 各队列的任务数
-    if not app.celery:
-        return total_msg, messages
-    for key in queues:
-        try:
-            channel = app.celery.connection().channel()
-            queue_info2 = channel.queue_declare(key, passive=False)
-            message_count = queue_info2.message_count
-            total_msg += message_count
-            messages[key] = message_count
-        except Exception as e:
-            logger.exception(f'获取队列{key}信息失败:{e}')
+    # 参数完全相同的，认为是重复子任务。每组保留最新的一条
+    pipeline = [
+        {'$match': {'queue': queue, 'digest': {'$exists': True, '$ne': None}}},  # 没有摘要的总是保留
+        {'$group': {'_id': '$digest', 'keep_id': {'$max': '$_id'}, 'count': {'$sum': 1}}},
+        # 不重复的合并成一条(_id 为 None)，只用来统计数量
+        {'$group': {'_id': {'$cond': [{'$gt': ['$count', 1]}, '$_id', None]},
+                    'keep_id': {'$first': '$keep_id'}, 'count': {'$sum': '$count'}}},
+    ]
+    matched = 0
+    removed = 0
+    deletes = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        matched += group['count']
+        if group['_id'] is None:
+            continue
+        deletes.append(DeleteMany({'queue': queue, 'digest': group['_id'], '_id': {'$ne': group['keep_id']}}))
+        if len(deletes) >= batch:
+            removed += collection.bulk_write(deletes, ordered=False).deleted_count
+            deletes = []
+    if deletes:
+        removed += collection.bulk_write(deletes, ordered=False).deleted_count
 
-    """
-    broker_url = app.celery.conf.broker_url
-    if broker_url.startswith('mongodb://'):
-        db = get_mongo_db(broker_url)
-        # total_msg = db.messages.count_documents()
-        for key in queues:
-            size = db.messages.count_documents({"queue": key})
-            total_msg += size
-            messages[key] = size
-    elif broker_url.startswith('redis://'):
-        conn = get_redis_client(broker_url)
-        for key in queues:
-            size = conn.llen(key)
-            total_msg += size
-            messages[key] = size
-    # 使用 RabbitMQ
-    elif broker_url.startswith(('amqp://', 'pyamqp://', 'rpc://')):
-        pass  # todo: 未实现
-    # """
+    stats = {'queue': queue, 'scanned': matched, 'digested': scanned, 'removed': removed,
+             'seconds': round(time.time() - start_time, 4)}
+    logger.warning('删除重复任务: %s', stats)
+    return stats
 
-    return total_msg, messages
 
+def get_pending_msg():
+    """获取正在准备执行的worker任务数量(读取队列深度采样的缓存，不访问 broker)"""
+    from .queue_util import get_sampler
+    messages = get_sampler().depths  # 各队列的任务数
+    total_msg = sum(messages.values())  # 总任务数
+    return total_msg, dict(messages)
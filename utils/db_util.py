@@ -1,32 +1,121 @@
 # -*- coding: utf-8 -*-
+"""
+数据库连接: 同一个连接字符串在进程内共用一个客户端(连接池)
+fork 出来的子进程(如 prefork 的 worker)不能沿用父进程的连接，发现进程号变了会重新创建；
+mongodb 按 DB_HEALTH_CHECK_INTERVAL 间隔在使用时检查连接，redis 由连接池按同样的间隔检查；进程退出时关闭所有连接。
+任务代码里直接调用 get_redis_client / get_mongo_db 即可共用这些连接池。
+"""
+import os
+import time
+import atexit
 import logging
+import threading
 
 from pymongo import MongoClient, uri_parser
 
+import settings
 
 logger = logging.getLogger(__name__)
 
+CLIENTS = {}  # 已创建的客户端 {(类型, 连接字符串): 客户端}
+_CHECKED = {}  # 上次检查连接的时间 {连接字符串: 时间}
+_LOCK = threading.Lock()
+_PID = os.getpid()  # 创建这些客户端的进程ID
+
+
+def _check_pid():
+    """fork 之后，父进程的客户端不能在子进程里使用，丢弃后重新创建(不关闭，避免影响父进程的连接)"""
+    global _PID
+    pid = os.getpid()
+    if pid != _PID:
+        with _LOCK:
+            if pid != _PID:
+                CLIENTS.clear()
+                _CHECKED.clear()
+                _PID = pid
+
+
+def _get_client(kind, url, create):
+    """取得已创建的客户端，没有则创建"""
+    _check_pid()
+    key = (kind, url)
+    client = CLIENTS.get(key)
+    if client is None:
+        with _LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = CLIENTS[key] = create(url)
+    return client
+
+
+def _close(client):
+    """关闭客户端(redis 客户端使用外部传入的连接池，需要关闭连接池)"""
+    pool = getattr(client, 'connection_pool', None)
+    if pool is not None:
+        pool.disconnect()
+    else:
+        client.close()
+
+
+def _discard_client(kind, url):
+    """去掉连接出错的客户端，下次使用时重新创建"""
+    with _LOCK:
+        client = CLIENTS.pop((kind, url), None)
+        _CHECKED.pop(url, None)
+    if client is not None:
+        try:
+            _close(client)
+        except Exception:
+            pass
+
+
+def get_mongo_client(uri):
+    """获取对应字符串的 mongodb 客户端(进程内共用)"""
+    return _get_client('mongo', uri, lambda url: MongoClient(url, serverSelectionTimeoutMS=5000))
+
 
 def get_mongo_db(uri):
-    """获取对应字符串的mongodb连接"""
+    """获取对应字符串的mongodb连接，连不上返回 None"""
     try:
-        client = MongoClient(uri, serverSelectionTimeoutMS=5000)
-        parsed = uri_parser.parse_uri(uri)
-        db_name = parsed.get('database')
+        client = get_mongo_client(uri)
+        db_name = uri_parser.parse_uri(uri).get('database')
         db = client[db_name]
-        db.test.find_one()  # test connection
+        now = time.time()
+        if now - _CHECKED.get(uri, 0) >= settings.DB_HEALTH_CHECK_INTERVAL:
+            db.command('ping')  # test connection
+            _CHECKED[uri] = now
         return db
-    except:
+    except Exception as e:
+        logger.warning('mongodb 连接出错: %s', e)
+        _discard_client('mongo', uri)
         return None
 
 
 def get_redis_client(redis_url):
-    import redis
-    pool = redis.ConnectionPool.from_url(
-        redis_url,
-        # decode_components=True,
-        # decode_responses=True,
-    )
-    redis_client = redis.Redis(connection_pool=pool)
-    return redis_client
+    """获取对应字符串的 redis 客户端(进程内共用一个连接池)"""
+    def create(url):
+        import redis
+        pool = redis.ConnectionPool.from_url(
+            url,
+            health_check_interval=settings.DB_HEALTH_CHECK_INTERVAL,  # 连接空闲超过这个时间，使用前先 PING
+            # decode_components=True,
+            # decode_responses=True,
+        )
+        return redis.Redis(connection_pool=pool)
+    return _get_client('redis', redis_url, create)
+
 
+@atexit.register
+def close_all():
+    """关闭所有客户端(只关闭本进程创建的)"""
+    if os.getpid() != _PID:
+        return
+    with _LOCK:
+        clients = list(CLIENTS.values())
+        CLIENTS.clear()
+        _CHECKED.clear()
+    for client in clients:
+        try:
+            _close(client)
+        except Exception as e:
+            logger.debug('关闭数据库连接出错: %s', e)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+抛出任务时的去重(幂等)处理
+任务名及参数完全相同的任务，在时间窗口内只抛出一次，重复抛出的直接合并到第一次抛出的任务上。
+"""
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .str_util import decode2str
+from .bson_util import BsonEncoder
+import settings
+
+logger = logging.getLogger(__name__)
+
+SEEN_SET = None  # 去重记录
+
+
+class LocalSeenSet(object):
+    """进程内的去重记录(带过期时间的 LRU 缓存)"""
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.SEND_TASK_DEDUP_SIZE
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, value, ttl):
+        """
+        记录不存在(或已过期)则写入并返回 None，否则返回之前写入的值
+        :param key: 去重的 key
+        :param value: 写入的值(任务id)
+        :param ttl: 过期时间(秒)
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[1] > now:
+                self._items.move_to_end(key)
+                return item[0]
+            self._items[key] = (value, now + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return None
+
+    def discard(self, key, value):
+        """删除记录(只删除自己写入的，值不同说明已被别的任务写入)"""
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] == value:
+                del self._items[key]
+
+
+class RedisSeenSet(object):
+    """使用 redis 的去重记录(SET NX EX)，多个进程/机器共享"""
+
+    def __init__(self, url, prefix=None):
+        from .db_util import get_redis_client
+        self.conn = get_redis_client(url)
+        self.prefix = prefix or f'{settings.APP_NAME}:send_task:'
+
+    def add(self, key, value, ttl):
+        """
+        记录不存在(或已过期)则写入并返回 None，否则返回之前写入的值
+        :param key: 去重的 key
+        :param value: 写入的值(任务id)
+        :param ttl: 过期时间(秒)
+        """
+        key = self.prefix + key
+        if self.conn.set(key, value, nx=True, ex=ttl):
+            return None
+        return decode2str(self.conn.get(key))
+
+    def discard(self, key, value):
+        """删除记录(只删除自己写入的，值不同说明已被别的任务写入)"""
+        self.conn.eval(_DISCARD_SCRIPT, 1, self.prefix + key, value)
+
+
+# 值相同才删除(比较及删除需要原子执行)
+_DISCARD_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_seen_set():
+    """获取去重记录"""
+    global SEEN_SET
+    if SEEN_SET is None:
+        url = settings.SEND_TASK_DEDUP_URL
+        SEEN_SET = RedisSeenSet(url) if url.startswith(('redis://', 'rediss://')) else LocalSeenSet()
+    return SEEN_SET
+
+
+def task_digest(name, args=None, kwargs=None):
+    """计算 任务名+参数 的摘要(kwargs 按 key 排序，保证相同参数得到相同的摘要)"""
+    content = json.dumps([name, args or [], kwargs or {}], cls=BsonEncoder, sort_keys=True)
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def check_repeat(name, args, kwargs, task_id, window):
+    """
+    检查任务是否在时间窗口内重复抛出
+    :param name: 任务名
+    :param args: 任务参数
+    :param kwargs: 任务参数
+    :param task_id: 本次抛出的任务id
+    :param window: 时间窗口(秒)
+    :return: 重复则返回之前抛出的任务id，不重复返回 None(已记录本次的任务id，发送失败时需调用 release_repeat)
+    """
+    try:
+        key = task_digest(name, args, kwargs)
+    except (TypeError, ValueError) as e:
+        logger.debug('任务参数无法计算摘要，不去重: %s, %s', name, e)
+        return None
+    return get_seen_set().add(key, task_id, window)
+
+
+def release_repeat(name, args, kwargs, task_id):
+    """任务发送失败时删除 check_repeat 的记录，否则时间窗口内重新发送都会被当作重复"""
+    try:
+        get_seen_set().discard(task_digest(name, args, kwargs), task_id)
+    except Exception as e:
+        logger.warning('删除任务去重记录出错: %s, %s', name, e)
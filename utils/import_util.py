@@ -2,6 +2,7 @@
 import os
 import re
 import sys
+import time
 import logging
 import inspect
 import pkgutil
@@ -9,6 +10,8 @@ import importlib
 
 logger = logging.getLogger(__name__)
 
+IMPORT_TIMES = {}  # import_submodules 加载各模块的耗时(秒)，用于启动耗时分析
+
 
 def import_string(import_name: str):
     """Imports an object based on a string.  This is useful if you want to
@@ -57,10 +60,12 @@ def import_submodules(package, recursive=True):
         if name.startswith('_'):
             continue
         full_name = package.__name__ + '.' + name
+        start = time.perf_counter()
         try:
             results[full_name] = importlib.import_module(full_name)
         except Exception as e:
             logger.error('Failed to import %s: %s', full_name, e)
+        IMPORT_TIMES[full_name] = time.perf_counter() - start
         if recursive and is_pkg:
             results.update(import_submodules(full_name))
     return results
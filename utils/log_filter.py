@@ -6,15 +6,23 @@ Log Filter, color and disable head method
 
 import os
 import sys
+import copy
 import time
+import queue
+import atexit
 import datetime
 import decimal
+import numbers
+import threading
 import uuid
 import logging
 import logging.config
-from logging.handlers import TimedRotatingFileHandler as fileHandler
+import multiprocessing
+from logging.handlers import TimedRotatingFileHandler as fileHandler, QueueHandler, QueueListener
+from collections.abc import Mapping
 
-from celery.signals import after_setup_logger, after_setup_task_logger
+from celery import current_task
+from celery.signals import after_setup_logger, after_setup_task_logger, worker_process_shutdown
 
 DEBUG = os.environ.get('DEBUG', '').lower() in ('true', '1')
 
@@ -23,6 +31,15 @@ LOG_MIN = 50  # 嵌套日志的最短长度，过短会导致无限递归截取
 LOG_PARAM_LEN = int(os.environ.get('LOG_PARAM_LEN') or 200)
 # 数据库日志的日志级别: DEBUG=10, INFO=20, WARNING=30, ERROR=40, CRITICAL=50
 DB_LOG_LEVEL = int(os.environ.get('DB_LOG_LEVEL') or 40)
+# 日志队列模式，为空则各进程直接写日志:
+# thread: 业务代码只把日志放进队列，由后台线程格式化、截取、写文件(适合 solo/threads/gevent 等单进程的任务池)
+# process: prefork 子进程共用一个跨进程队列，由主进程的后台线程统一写文件(只有一个进程写文件、切割文件)
+LOG_QUEUE = (os.environ.get('LOG_QUEUE') or '').lower()
+# 日志限流，按 logger 名称(含下级 logger)或任务名称配置，多个用逗号分隔，WARNING 及以上级别的日志不限流。如:
+# tasks.master_fetch=10/s: 每秒最多10条; my_celery_mq.tasks.ping=1/100: 每100条保留1条; 两者可用 | 组合，如: 100/s|1/10
+LOG_RATE_LIMITS = os.environ.get('LOG_RATE_LIMITS') or ''
+# 日志限流时，每隔多少秒汇总输出一次被丢弃的日志数量
+LOG_RATE_SUMMARY = float(os.environ.get('LOG_RATE_SUMMARY') or 60)
 
 _FORMAT = '[%(asctime)s] [%(module)s.%(funcName)s:%(lineno)s] %(levelname)s: %(message)s'
 _formatter = logging.Formatter(_FORMAT)
@@ -93,6 +110,116 @@ def deep_short_log(value, length=None):
         return short_log(value, length=length)
 
 
+def budget_str(value, budget=None, quote=False):
+    """
+    按字符预算截取，单次遍历生成字符串: 嵌套的 dict、list 等共用同一份预算，预算用完即停止遍历，
+    不会先生成大对象的完整字符串再截取(只有未知类型的对象才会调用它自己的 str/repr)
+    :param value: 任意值
+    :param budget: 最多输出的字符数(大约，超出部分用 ... 表示)
+    :param quote: 字符串是否加引号(True 时等同 repr 的效果，容器内的元素总是加引号)
+    """
+    budget = max(budget or LOG_PARAM_LEN, LOG_MIN)  # 长度不能无限小
+    out = []
+    _budget_walk(value, out, [budget], quote)
+    return ''.join(out)
+
+
+def _budget_text(text, out, left):
+    """输出一段文本，超出剩余预算则截取首尾(很短的文本不截取，如数值)"""
+    if len(text) > max(left[0], 20):
+        half = max(left[0] // 2, 1)
+        text = text[:half] + '...' + text[-half:]
+    out.append(text)
+    left[0] -= len(text)
+
+
+def _budget_sep(index, size, out, left):
+    """输出容器第 index 个元素前的分隔符，预算用完则输出剩余数量并返回 False"""
+    if index:
+        out.append(', ')
+        left[0] -= 2
+    if left[0] <= 0:
+        out.append(f'...({size - index} more)')
+        return False
+    return True
+
+
+def _budget_walk(value, out, left, quote):
+    """按剩余预算 left[0] 输出 value"""
+    if left[0] <= 0:
+        out.append('...')
+        return
+    if isinstance(value, str):
+        if len(value) > left[0]:  # 只取首尾，不处理整个字符串
+            half = max(left[0] // 2, 1)
+            text = (repr(value[:half]) + '...' + repr(value[-half:])) if quote else (value[:half] + '...' + value[-half:])
+        else:
+            text = repr(value) if quote else value
+        out.append(text)
+        left[0] -= len(text)
+    elif isinstance(value, (bytes, bytearray)):
+        if len(value) > left[0]:
+            half = max(left[0] // 2, 1)
+            text = repr(bytes(value[:half])) + '...' + repr(bytes(value[-half:]))
+        else:
+            text = repr(value)
+        out.append(text)
+        left[0] -= len(text)
+    elif isinstance(value, dict):
+        out.append('{')
+        left[0] -= 1
+        for i, (key, item) in enumerate(value.items()):
+            if not _budget_sep(i, len(value), out, left):
+                break
+            _budget_walk(key, out, left, True)
+            out.append(': ')
+            left[0] -= 2
+            _budget_walk(item, out, left, True)
+        out.append('}')
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        start, end = ('[', ']') if isinstance(value, list) else ('(', ')') if isinstance(value, tuple) else ('{', '}')
+        out.append(start)
+        left[0] -= 1
+        for i, item in enumerate(value):
+            if not _budget_sep(i, len(value), out, left):
+                break
+            _budget_walk(item, out, left, True)
+        out.append(end)
+    elif isinstance(value, int) and value.bit_length() > 1024 and value.bit_length() * 0.3 > left[0]:
+        # 几千位的整数转字符串很慢(超过 4300 位还会报错)，只输出位数
+        text = f'<int {value.bit_length()} bits>'
+        out.append(text)
+        left[0] -= len(text)
+    else:
+        try:
+            text = repr(value) if quote else str(value)
+        except Exception as e:
+            text = f'<{type(value).__name__} {e!r}>'
+        _budget_text(text, out, left)
+
+
+class BudgetArg(object):
+    """日志参数的包装: 格式化(%s / %r)时才按预算截取"""
+    __slots__ = ('value', 'budget')
+
+    def __init__(self, value, budget):
+        self.value = value
+        self.budget = budget
+
+    def __str__(self):
+        return budget_str(self.value, self.budget)
+
+    def __repr__(self):
+        return budget_str(self.value, self.budget, quote=True)
+
+
+def _wrap_arg(value, budget):
+    """数值(包括大整数、numpy 的数值)保持原样(%d、%.2f 等格式需要)，其它的包装成按预算截取"""
+    if isinstance(value, numbers.Number):
+        return value
+    return BudgetArg(value, budget)
+
+
 class StringFilter(logging.Filter):
     """用于截取日志的字符串，避免日志内容过长
     对于内嵌的 dict、list 等，会嵌套截取长度，每嵌套一层则长度限制变短一倍
@@ -105,25 +232,34 @@ class StringFilter(logging.Filter):
         if hasattr(record, '_filter_msg'):
             return record._filter_msg
         else:
-            # 保存原值
-            record.old_msg = record.getMessage()
+            # 保存原值(不格式化，避免为了保存原值而把大参数完整转成字符串)
+            record.old_msg = msg
+            record.old_args = record.args
         if isinstance(msg, (bytes, bytearray)):
-            msg = msg.decode()
+            msg = budget_str(msg.decode(errors='replace'), LOG_PARAM_LEN * 3)
         elif not isinstance(msg, str):
             try:
-                msg = str(msg)
+                msg = budget_str(msg, LOG_PARAM_LEN * 3)
             except Exception as e:
-                logging.exception('日志值类型格式化错误:%s, %s', e, msg)
+                logging.exception('日志值类型格式化错误:%s, %s', e, type(msg))
                 record._filter_msg = False
                 return False  # 报异常就别再打印此日志了
         if isinstance(msg, str) and '%' in msg and record.args:
             try:
                 args = record.args
-                # list,tuple,set,dict 类型,递归转换
-                if isinstance(args, (list, tuple, set, dict)):
-                    args = deep_short_log(args, length=LOG_PARAM_LEN)
-                # 字符串合并
-                msg %= args
+                # 各参数按预算截取(格式化时才截取，且不会生成大参数的完整字符串)
+                if isinstance(args, Mapping):
+                    if '%(' in msg:  # 按名称格式化: logger.info('%(a)s', {'a': 1})
+                        args = {key: _wrap_arg(value, LOG_PARAM_LEN) for key, value in args.items()}
+                    else:  # 唯一的参数是 dict: logger.info('%s', big_dict)，整个 dict 按预算截取
+                        args = (_wrap_arg(args, LOG_PARAM_LEN),)
+                elif isinstance(args, tuple):
+                    args = tuple(_wrap_arg(value, LOG_PARAM_LEN) for value in args)
+                # 字符串合并(包装后的参数不支持 %d 等格式时，用原参数格式化，再整体截取)
+                try:
+                    msg %= args
+                except TypeError:
+                    msg %= record.args
                 record.args = ()
             # 捕获未知错误，有可能日志里包含二进制、错误编码等
             except Exception as e:
@@ -151,8 +287,103 @@ class LevelFilter(object):
         return self.min_level <= record.levelno <= self.max_level
 
 
+class RateLimitFilter(logging.Filter):
+    """日志抽样及限流
+    按 logger 名称(含下级 logger)或当前任务名称匹配规则: 每秒最多 N 条、每 K 条保留 1 条
+    WARNING 及以上级别的日志总是保留，被丢弃的数量定时汇总输出
+    """
+
+    def __init__(self, rules, summary_interval=None):
+        super().__init__()
+        self.rules = rules  # {名称: (每秒最多条数, 每几条保留1条)}
+        self.summary_interval = summary_interval or LOG_RATE_SUMMARY
+        self._lock = threading.Lock()
+        self._windows = {}  # {名称: [当前这一秒的开始时间, 已输出条数]}
+        self._counters = {}  # {名称: 累计条数}
+        self._suppressed = {}  # {名称: 丢弃条数}
+        self._last_summary = time.time()
+
+    @classmethod
+    def parse(cls, text):
+        """解析规则，如: tasks.master_fetch=10/s,my_celery_mq.tasks.ping=1/100|100/s"""
+        rules = {}
+        for item in text.split(','):
+            if '=' not in item:
+                continue
+            name, spec = (x.strip() for x in item.split('=', 1))
+            rate, sample = 0, 1
+            for part in spec.split('|'):
+                num, _, unit = part.strip().partition('/')
+                if unit.strip() == 's':
+                    rate = float(num)
+                elif num.strip() == '1' and unit.strip().isdigit():
+                    sample = int(unit)
+            if name and (rate or sample > 1):
+                rules[name] = (rate, sample)
+        return rules
+
+    def _match(self, record):
+        """匹配规则的名称: logger 名称及其上级，或者当前任务的名称"""
+        name = record.name
+        while name:
+            if name in self.rules:
+                return name
+            name = name.rpartition('.')[0]
+        task_name = getattr(current_task, 'name', None)
+        if task_name in self.rules:
+            return task_name
+        return None
+
+    def filter(self, record):
+        # 同一条日志经过多个 handler 时，使用第一次的判断结果
+        keep = getattr(record, '_rate_keep', None)
+        if keep is not None:
+            return keep
+        keep = True
+        if record.levelno < logging.WARNING:
+            name = self._match(record)
+            if name is not None:
+                keep = self._allow(name)
+        record._rate_keep = keep
+        self._summary()
+        return keep
+
+    def _allow(self, name):
+        rate, sample = self.rules[name]
+        now = time.time()
+        with self._lock:
+            count = self._counters.get(name, 0) + 1
+            self._counters[name] = count
+            keep = count % sample == 1 or sample == 1
+            if keep and rate:
+                window = self._windows.setdefault(name, [now, 0])
+                if now - window[0] >= 1:
+                    window[0], window[1] = now, 0
+                keep = window[1] < rate
+                window[1] += keep
+            if not keep:
+                self._suppressed[name] = self._suppressed.get(name, 0) + 1
+        return keep
+
+    def _summary(self):
+        """定时输出被丢弃的日志数量"""
+        now = time.time()
+        if now - self._last_summary < self.summary_interval:
+            return
+        with self._lock:
+            if now - self._last_summary < self.summary_interval:
+                return
+            suppressed, self._suppressed = self._suppressed, {}
+            seconds, self._last_summary = now - self._last_summary, now
+        if suppressed:
+            logging.getLogger(__name__).warning('日志限流，最近%d秒丢弃的日志数量: %s', seconds, suppressed)
+
+
 string_filter = StringFilter()
 logger.addFilter(string_filter)
+# 日志限流(配置了 LOG_RATE_LIMITS 才启用)，放在截取之前，被丢弃的日志不用再截取
+_rate_rules = RateLimitFilter.parse(LOG_RATE_LIMITS)
+rate_filter = RateLimitFilter(_rate_rules) if _rate_rules else None
 # 排除屏幕输出(StandardErrorHandler)
 logger.handlers[:] = [h for h in logger.handlers if not isinstance(h, logging.StreamHandler)]
 
@@ -160,6 +391,8 @@ logger.handlers[:] = [h for h in logger.handlers if not isinstance(h, logging.St
 stdout_handler = logging.StreamHandler(sys.stdout)  # stdout
 stdout_handler.setFormatter(_formatter)
 stdout_handler.setLevel(_LEVEL)
+if rate_filter:
+    stdout_handler.addFilter(rate_filter)
 stdout_handler.addFilter(string_filter)
 stdout_handler.addFilter(LevelFilter(_LEVEL, logging.WARNING))
 logger.addHandler(stdout_handler)
@@ -172,6 +405,110 @@ logger.addHandler(stderr_handler)
 
 # 文件日志
 file_handler = None
+# 日志队列(LOG_QUEUE 模式下，logger 上只有 queue_handler，其它 handler 都由 queue_listener 调用)
+queue_handler = None
+queue_listener = None
+_listener_pid = None
+
+
+class LogQueueHandler(QueueHandler):
+    """把日志放进队列"""
+
+    def prepare(self, record):
+        # 进队列前就合并参数(已由 string_filter 截取): 日志内容是调用 logger.* 时参数的值，而不是监听线程格式化时的值
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        # 同进程的队列，异常信息原样交给监听线程格式化
+        if isinstance(self.queue, queue.Queue):
+            return record
+        # 跨进程的队列需要 pickle: 异常堆栈转成字符串
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.__dict__.pop('old_msg', None)
+        record.__dict__.pop('old_args', None)
+        return record
+
+
+def _attach_handlers():
+    """给 logger 加上日志处理器"""
+    if queue_handler is not None:
+        logger.addHandler(queue_handler)
+        return
+    if file_handler:
+        logger.addHandler(file_handler)
+    logger.addHandler(stdout_handler)
+    logger.addHandler(stderr_handler)
+
+
+def setup_log_queue(mode=None):
+    """
+    启用日志队列(需要在 add_file_handler 之后、fork 子进程之前调用)
+    :param {string} mode: thread / process，默认取环境变量 LOG_QUEUE，为空则不启用
+    """
+    global queue_handler, queue_listener, _listener_pid
+    mode = (mode or LOG_QUEUE).lower()
+    if not mode or queue_listener is not None:
+        return
+    if mode not in ('thread', 'process'):
+        logging.warning('不支持的日志队列模式: %s', mode)
+        return
+    log_queue = multiprocessing.Queue(-1) if mode == 'process' else queue.Queue(-1)
+    handlers = [h for h in (file_handler, stdout_handler, stderr_handler) if h]
+    queue_handler = LogQueueHandler(log_queue)
+    if rate_filter:
+        queue_handler.addFilter(rate_filter)  # 被限流的日志不进队列
+    queue_handler.addFilter(string_filter)  # 进队列前先截取，合并参数时不会完整格式化大参数
+    logger.handlers[:] = [h for h in logger.handlers if h not in handlers and not isinstance(h, QueueHandler)]
+    logger.addHandler(queue_handler)
+    queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    _listener_pid = os.getpid()
+
+
+def _restart_thread_listener():
+    """fork 出来的子进程里没有监听线程，thread 模式下重新创建一个(process 模式则继续使用主进程的)"""
+    global queue_handler, queue_listener, _listener_pid
+    if queue_listener is None or not isinstance(queue_handler.queue, queue.Queue):
+        return
+    log_queue = queue.Queue(-1)
+    logger.removeHandler(queue_handler)
+    filters = queue_handler.filters
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.filters = list(filters)
+    logger.addHandler(queue_handler)
+    queue_listener = QueueListener(log_queue, *queue_listener.handlers, respect_handler_level=True)
+    queue_listener.start()
+    _listener_pid = os.getpid()
+
+
+def stop_log_queue():
+    """写完队列中剩余的日志，停止监听线程"""
+    global queue_listener
+    if queue_listener is not None and _listener_pid == os.getpid():
+        queue_listener.stop()
+        queue_listener = None
+
+
+def flush_log_queue(**kwargs):
+    """
+    prefork 子进程退出前，把还在本进程缓冲里的日志写进共享队列(process 模式)
+    子进程退出时不会等待队列的后台写入线程，不 flush 的话，最后的日志会丢失
+    """
+    global queue_handler
+    if queue_handler is None or isinstance(queue_handler.queue, queue.Queue) or _listener_pid == os.getpid():
+        return
+    logger.removeHandler(queue_handler)
+    log_queue = queue_handler.queue
+    queue_handler = None
+    log_queue.close()
+    log_queue.join_thread()
+
+
+os.register_at_fork(after_in_child=_restart_thread_listener)
+atexit.register(stop_log_queue)
+worker_process_shutdown.connect(flush_log_queue, weak=False)
 
 
 @after_setup_task_logger.connect()
@@ -179,10 +516,7 @@ def task_logger_setup_handler(*args, **kwargs):
     """
     worker logger
     """
-    if file_handler:
-        logger.addHandler(file_handler)
-    logger.addHandler(stdout_handler)
-    logger.addHandler(stderr_handler)
+    _attach_handlers()
 
     logging.info("task log handler connected -> Global Logging")
 
@@ -195,10 +529,7 @@ def global_logger_setup_handler(*args, **kwargs):
     # 排除屏幕输出(StandardErrorHandler)
     logger.handlers[:] = [h for h in logger.handlers if not isinstance(h, logging.StreamHandler)]
 
-    if file_handler:
-        logger.addHandler(file_handler)
-    logger.addHandler(stdout_handler)
-    logger.addHandler(stderr_handler)
+    _attach_handlers()
 
     logging.info("celery log handler connected -> Global Logging")
 
@@ -232,6 +563,8 @@ def add_file_handler(log_file, logger_level, append=not DEBUG, backup_count=30,
     file_handler = fileHandler(log_file, when='midnight', backupCount=backup_count)
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logger_level)
+    if rate_filter:
+        file_handler.addFilter(rate_filter)
     file_handler.addFilter(string_filter)
     logger.addHandler(file_handler)
 
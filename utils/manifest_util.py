@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+任务清单: 缓存任务名、队列、定时配置及所在模块，加快 worker/beat 的启动
+
+第一次启动(或任务文件有改动)时，照常 import 所有任务模块，并把任务信息写到清单文件(settings.TASK_MANIFEST)。
+之后启动时只读取清单，注册轻量的代理任务(LazyTask)，不再 import 任务模块；
+收到某个任务时才 import 它所在的模块，注册真正的任务，代理任务把执行转交给真正的任务。
+注意: 任务名、队列等由环境变量决定的，环境变量(APP_NAME 及各队列名)改变后清单会自动重建。
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import datetime
+import importlib
+import importlib.util
+import threading
+
+from celery.exceptions import NotRegistered
+from celery.schedules import crontab
+
+from .celery_base_task import BaseTask
+import settings
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 3
+# 代理任务需要的任务属性(发送任务、重试、去重、队列堆积处理时用到)，只保存任务自己指定的
+TASK_ATTRS = ('queue', 'priority', 'max_retries', 'default_retry_delay', 'rate_limit', 'time_limit',
+              'soft_time_limit', 'acks_late', 'ignore_result', 'serializer', 'expires',
+              'dedup_window', 'backpressure', 'backpressure_timeout', 'overflow_queue')
+DEFAULT_STRATEGY = BaseTask.Strategy
+# 代理任务执行的是 BaseTask 的这些方法，任务重写了的话，所在模块启动时照常 import
+TASK_HOOKS = ('before_start', 'on_success', 'on_failure', 'on_retry', 'after_return', '__call__')
+REAL_TASKS = {}  # 已 import 的真正的任务 {任务名: 任务}
+
+
+def dump_schedule(schedule):
+    """定时配置转成可以 json 保存的格式，不支持的返回 None"""
+    if isinstance(schedule, bool):
+        return None
+    if isinstance(schedule, (int, float)):
+        return {'type': 'number', 'value': schedule}
+    if isinstance(schedule, datetime.timedelta):
+        return {'type': 'number', 'value': schedule.total_seconds()}
+    if type(schedule) is crontab:
+        return {'type': 'crontab', 'minute': schedule._orig_minute, 'hour': schedule._orig_hour,
+                'day_of_week': schedule._orig_day_of_week, 'day_of_month': schedule._orig_day_of_month,
+                'month_of_year': schedule._orig_month_of_year}
+    return None
+
+
+def load_schedule(data):
+    """dump_schedule 的逆操作"""
+    if data['type'] == 'number':
+        return data['value']
+    return crontab(minute=data['minute'], hour=data['hour'], day_of_week=data['day_of_week'],
+                   day_of_month=data['day_of_month'], month_of_year=data['month_of_year'])
+
+
+def _package_dir(path):
+    """任务包所在的目录(不依赖启动时的当前目录)"""
+    spec = importlib.util.find_spec(path)
+    if spec is not None and spec.submodule_search_locations:
+        return list(spec.submodule_search_locations)[0]
+    return os.path.abspath(path.replace('.', os.sep))
+
+
+def _fingerprint(path):
+    """任务目录下所有 py 文件及修改时间，加上决定任务名/队列的配置，任何一个变化清单都需要重建"""
+    package_dir = _package_dir(path)
+    files = []
+    for root, dirs, names in os.walk(package_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('_', '.')))
+        for name in sorted(names):
+            if name.endswith('.py'):
+                file_path = os.path.join(root, name)
+                files.append(f'{os.path.relpath(file_path, package_dir)}:{os.stat(file_path).st_mtime_ns}')
+    files.append(f'{settings.APP_NAME}:{",".join(settings.ALL_QUEUES)}')
+    # 任务属性的默认值来自这些配置，配置改变后需要重新判断哪些属性是任务自己指定的
+    files.extend(f'{name}:{getattr(settings.CELERY_CONFIG, name, None)!r}' for _, name in BaseTask.from_config)
+    return hashlib.md5('\n'.join(files).encode('utf-8')).hexdigest()
+
+
+def read_manifest(manifest_path, path):
+    """读取任务清单，不存在、格式不对或已过期则返回 None"""
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except Exception as e:
+        logger.warning('读取任务清单出错，重新生成: %s, %s', manifest_path, e)
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('path') != path:
+        return None
+    if manifest.get('fingerprint') != _fingerprint(path):
+        logger.info('任务文件有改动，重新生成任务清单: %s', manifest_path)
+        return None
+    return manifest
+
+
+def _has_custom_hooks(task):
+    """任务是否重写了 BaseTask 的事件方法(代理任务只会执行 BaseTask 的)"""
+    task_cls = task.__class__  # 装饰器的任务是 Proxy，type() 取不到真正的类
+    return any(getattr(task_cls, hook, None) is not getattr(BaseTask, hook, None) for hook in TASK_HOOKS)
+
+
+def _task_attrs(task):
+    """
+    任务自己指定的属性(与 BaseTask 或 app 配置的默认值不同的)
+    默认值不写进清单，代理任务注册时按当前配置取得，配置改变不会沿用清单里的旧值
+    """
+    from_config = dict(task.from_config)
+    attrs = {}
+    for key in TASK_ATTRS:
+        value = getattr(task, key, None)
+        if not isinstance(value, (str, int, float, bool)):
+            continue
+        default = task.app.conf.get(from_config[key]) if key in from_config else getattr(BaseTask, key, None)
+        if value != default or type(value) is not type(default):
+            attrs[key] = value
+    return attrs
+
+
+def write_manifest(manifest_path, path, entries):
+    """
+    根据 load_task 注册的任务生成清单
+    :param entries: celery_util.register_module_tasks 返回的任务信息
+    """
+    tasks, eager_modules = {}, set()
+    for entry in entries:
+        task = entry['task']
+        module = task.__class__.__module__  # 装饰器的任务是 Proxy，type() 取不到真正的类
+        schedule = entry['schedule']
+        item = {
+            'module': module,
+            'attrs': _task_attrs(task),
+            'schedule': dump_schedule(schedule) if schedule else None,
+        }
+        # 自定义消息处理策略(如 BatchTask)、重写了任务事件、不支持的定时配置，所在模块启动时照常 import
+        if getattr(task, 'Strategy', DEFAULT_STRATEGY) != DEFAULT_STRATEGY or _has_custom_hooks(task) \
+                or (schedule and item['schedule'] is None):
+            eager_modules.add(module)
+        tasks.setdefault(entry['name'], item)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'path': path,
+        'fingerprint': _fingerprint(path),
+        'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'eager_modules': sorted(eager_modules),
+        'tasks': tasks,
+    }
+    folder = os.path.dirname(manifest_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+    logger.info('生成任务清单: %s, 任务数: %s', manifest_path, len(tasks))
+    return manifest
+
+
+class LazyTask(BaseTask):
+    """代理任务: 第一次执行时才 import 真正的任务模块，之后把执行转交给真正的任务"""
+    module_name = None  # 真正的任务所在的模块
+    _real = None
+    _resolve_lock = threading.RLock()
+
+    def _resolve(self):
+        """取得真正的任务"""
+        real = self._real
+        if real is not None:
+            return real
+        with LazyTask._resolve_lock:
+            real = REAL_TASKS.get(self.name)
+            if real is None:
+                import_module_tasks(self.module_name, self.app)
+                real = REAL_TASKS.get(self.name)
+            if real is None:
+                raise NotRegistered(self.name)
+            type(self)._real = real
+        return real
+
+    def run(self, *args, **kwargs):
+        real = self._resolve()
+        # 把当前任务的请求信息(任务id、重试次数等)交给真正的任务
+        stack = self.request_stack.stack
+        request = next((r for r in reversed(stack) if getattr(r, 'id', None)), self.request)
+        real.push_request(**dict(request.__dict__))
+        try:
+            return real._run_fun(real.run, *args, **kwargs)
+        finally:
+            real.pop_request()
+
+
+def import_module_tasks(module_name, app):
+    """
+    import 任务模块并注册真正的任务
+    先去掉该模块的代理任务(否则 @task 装饰器会返回已注册的代理任务)，注册完再把代理任务放回去:
+    worker 启动时已按代理任务建好了消息处理策略及 tracer，收到的任务仍由代理任务转交给真正的任务
+    """
+    from .celery_util import register_module_tasks
+    proxies = {name: task for name, task in app.tasks.items()
+               if isinstance(task, LazyTask) and task.module_name == module_name}
+    for name in proxies:
+        app.tasks.pop(name)
+    app.set_current()  # 模块里的 @current_app.task 需要拿到当前的 app
+    try:
+        module = sys.modules.get(module_name)
+        # 已经被其它模块 import 过的(当时拿到的是代理任务)，需要重新执行一次模块
+        module = importlib.reload(module) if module is not None else importlib.import_module(module_name)
+        logger.info('Lazy import task module: %s', module_name)
+        entries = register_module_tasks(module, app)
+        for entry in entries:
+            REAL_TASKS[entry['name']] = entry['task']
+    finally:
+        for name, proxy in proxies.items():
+            app.tasks[name] = proxy
+            BaseTask.tasks[name] = proxy
+    return entries
+
+
+def register_lazy_tasks(manifest, app):
+    """
+    按清单注册代理任务
+    :return: 定时任务配置
+    """
+    beat_schedule = {}
+    lazy_count = 0
+    eager_modules = set(manifest.get('eager_modules') or ())
+    for module_name in sorted(eager_modules):
+        for entry in import_module_tasks(module_name, app):
+            if entry['schedule']:
+                beat_schedule[entry['name']] = {'task': entry['name'], 'schedule': entry['schedule']}
+    for name, item in manifest['tasks'].items():
+        if item['schedule']:
+            beat_schedule.setdefault(name, {'task': name, 'schedule': load_schedule(item['schedule'])})
+        if item['module'] in eager_modules:
+            continue
+        # 每个代理任务一个类(celery 把发送任务的参数缓存在类上)
+        task_cls = type(name.rsplit('.', 1)[-1], (LazyTask,), dict(item['attrs'], name=name, module_name=item['module'],
+                                                                     __module__=item['module']))
+        task = app.register_task(task_cls())
+        BaseTask.tasks[name] = task
+        lazy_count += 1
+    logger.info('Loading Task (LAZY): %s, eager modules: %s', lazy_count, len(eager_modules))
+    return beat_schedule
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+任务耗时统计
+每个任务名一个固定分桶的耗时直方图，及成功/重试/失败次数，保存在共享内存里。
+共享内存在主进程 import 时创建(早于 prefork 的 fork)，所有子进程写入同一份数据，主进程汇总输出快照文件。
+"""
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+import multiprocessing
+
+from celery.signals import worker_ready, worker_shutdown
+import settings
+
+logger = logging.getLogger(__name__)
+
+# 耗时分桶的上限(秒)，最后一个桶是超过 60 秒的
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+STATUSES = ('success', 'retry', 'failure')
+NAME_SIZE = 128  # 任务名最多保存的字节数
+# 每个任务一个槽位: 任务名, 成功/重试/失败次数, 耗时总和, 最大耗时, 各桶的次数
+SLOT = struct.Struct(f'<{NAME_SIZE}s{len(STATUSES)}Qdd{len(BUCKETS)}Q')
+HEADER = struct.Struct('<Q')  # 已使用的槽位数量
+_COUNTS_OFFSET = NAME_SIZE
+_SUM_OFFSET = _COUNTS_OFFSET + 8 * len(STATUSES)
+_MAX_OFFSET = _SUM_OFFSET + 8
+_BUCKETS_OFFSET = _MAX_OFFSET + 8
+
+_COUNTER = struct.Struct('<Q')
+_FLOAT = struct.Struct('<d')
+
+
+class TaskMetrics(object):
+    """共享内存里的任务耗时统计"""
+
+    def __init__(self, max_tasks=None):
+        self.max_tasks = max_tasks or settings.METRICS_MAX_TASKS
+        # 匿名共享内存，fork 出来的子进程共用
+        self.buf = mmap.mmap(-1, HEADER.size + SLOT.size * self.max_tasks)
+        self.lock = multiprocessing.Lock()
+        self._slots = {}  # 进程内缓存 {任务名: 槽位序号}
+        self._full = False
+
+    def _offset(self, index):
+        return HEADER.size + SLOT.size * index
+
+    def _slot(self, name):
+        """任务名对应的槽位序号，没有则分配(调用方需持有锁)"""
+        index = self._slots.get(name)
+        if index is not None:
+            return index
+        raw_name = name.encode('utf-8')[:NAME_SIZE]
+        used = HEADER.unpack_from(self.buf, 0)[0]
+        for i in range(used):  # 可能是其它进程分配的
+            offset = self._offset(i)
+            if self.buf[offset:offset + NAME_SIZE].rstrip(b'\0') == raw_name:
+                self._slots[name] = i
+                return i
+        if used >= self.max_tasks:
+            if not self._full:
+                self._full = True
+                logger.warning('任务耗时统计的槽位已用完(METRICS_MAX_TASKS=%s)，任务 %s 不再统计', self.max_tasks, name)
+            return None
+        self.buf[self._offset(used):self._offset(used) + NAME_SIZE] = raw_name.ljust(NAME_SIZE, b'\0')
+        HEADER.pack_into(self.buf, 0, used + 1)
+        self._slots[name] = used
+        return used
+
+    def record(self, name, duration, status='success'):
+        """记录一次任务执行的耗时(秒)及结果(success/retry/failure)"""
+        bucket = next(i for i, bound in enumerate(BUCKETS) if duration <= bound)
+        with self.lock:
+            index = self._slot(name)
+            if index is None:
+                return
+            offset = self._offset(index)
+            for pos in (offset + _COUNTS_OFFSET + 8 * STATUSES.index(status), offset + _BUCKETS_OFFSET + 8 * bucket):
+                _COUNTER.pack_into(self.buf, pos, _COUNTER.unpack_from(self.buf, pos)[0] + 1)
+            _FLOAT.pack_into(self.buf, offset + _SUM_OFFSET, _FLOAT.unpack_from(self.buf, offset + _SUM_OFFSET)[0] + duration)
+            if duration > _FLOAT.unpack_from(self.buf, offset + _MAX_OFFSET)[0]:
+                _FLOAT.pack_into(self.buf, offset + _MAX_OFFSET, duration)
+
+    def snapshot(self):
+        """汇总各任务的统计: 次数、平均/最大耗时、p50/p95/p99(秒)"""
+        with self.lock:
+            used = HEADER.unpack_from(self.buf, 0)[0]
+            slots = [SLOT.unpack_from(self.buf, self._offset(i)) for i in range(used)]
+        result = {}
+        for slot in slots:
+            name = slot[0].rstrip(b'\0').decode('utf-8', 'ignore')
+            counts = slot[1:1 + len(STATUSES)]
+            total, max_duration = slot[1 + len(STATUSES):3 + len(STATUSES)]
+            buckets = slot[3 + len(STATUSES):]
+            count = sum(buckets)
+            item = dict(zip(STATUSES, counts))
+            item.update({
+                'count': count,
+                'avg': round(total / count, 6) if count else 0,
+                'max': round(max_duration, 6),
+                'p50': _percentile(buckets, count, 0.50, max_duration),
+                'p95': _percentile(buckets, count, 0.95, max_duration),
+                'p99': _percentile(buckets, count, 0.99, max_duration),
+                'buckets': {str(bound): n for bound, n in zip(BUCKETS, buckets) if n},
+            })
+            result[name] = item
+        return result
+
+
+def _percentile(buckets, count, q, max_duration):
+    """按分桶估算分位数(在命中的桶内线性插值，不超过最大耗时)"""
+    if not count:
+        return 0
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            lower = BUCKETS[i - 1] if i else 0
+            upper = min(BUCKETS[i], max_duration)
+            return round(lower + (upper - lower) * (rank - seen) / n, 6)
+        seen += n
+    return round(max_duration, 6)
+
+
+METRICS = TaskMetrics()  # import 时创建，fork 出来的子进程共用
+
+
+def record(name, duration, status='success'):
+    """记录一次任务执行(出错不影响任务本身)，没有设置 METRICS_FILE 则不统计"""
+    if not settings.METRICS_FILE:
+        return
+    try:
+        METRICS.record(name, duration, status)
+    except Exception as e:
+        logger.warning('记录任务耗时统计出错: %s, %s', name, e)
+
+
+def write_snapshot(path=None):
+    """把统计快照写到文件(先写临时文件再替换，读取方不会读到写了一半的文件)"""
+    path = path or settings.METRICS_FILE
+    if not path:
+        return None
+    data = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'pid': os.getpid(), 'tasks': METRICS.snapshot()}
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return data
+
+
+class SnapshotWriter(threading.Thread):
+    """定时写统计快照的后台线程(worker 主进程里运行)"""
+
+    def __init__(self, interval=None):
+        super().__init__(name='metrics-snapshot', daemon=True)
+        self.interval = interval or settings.METRICS_INTERVAL
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                write_snapshot()
+            except Exception as e:
+                logger.warning('写任务耗时统计快照出错: %s', e)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+WRITER = None
+
+
+@worker_ready.connect
+def start_snapshot_writer(**kwargs):
+    """worker 启动完成后(主进程)开始定时写快照"""
+    global WRITER
+    if settings.METRICS_FILE and WRITER is None:
+        WRITER = SnapshotWriter()
+        WRITER.start()
+
+
+@worker_shutdown.connect
+def stop_snapshot_writer(**kwargs):
+    """worker 退出时写最后一次快照"""
+    global WRITER
+    if WRITER is not None:
+        WRITER.stop()
+        WRITER = None
+        try:
+            write_snapshot()
+        except Exception as e:
+            logger.warning('写任务耗时统计快照出错: %s', e)
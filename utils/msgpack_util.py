@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+提供 msgpack 二进制序列化和反序列化，支持的类型: ObjectId, UUID, datetime(保留时区), date, Decimal。
+注意: struct_time 是 tuple 的子类，msgpack 直接按数组编码，解码后是 list(与 bson_util 不同)。
+自定义类型使用 msgpack 的扩展类型(ExtType)编码，比 json 的 {'__type__': ..., 'value': ...} 更小，解码时也不需要检查每一个 dict。
+主要用于 celery 任务参数的序列化和反序列化(需安装 msgpack)。
+"""
+import uuid
+import struct
+import decimal
+import datetime
+
+from bson.objectid import ObjectId
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 扩展类型编号
+EXT_OBJECT_ID = 1
+EXT_UUID = 2
+EXT_DATETIME = 3  # isoformat 字符串(保留时区及微秒，datetime.min/max 也可以编码)
+EXT_DATE = 4
+EXT_DECIMAL = 6  # 5 不再使用(struct_time 按数组编码)
+
+_INT = struct.Struct('>i')
+
+
+def _ext_encoder(obj):
+    if isinstance(obj, ObjectId):
+        return msgpack.ExtType(EXT_OBJECT_ID, obj.binary)
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode('ascii'))
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(EXT_DATE, _INT.pack(obj.toordinal()))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode('ascii'))
+    raise TypeError(f'Object of type {type(obj).__name__} is not msgpack serializable')
+
+
+def _ext_decoder(code, data):
+    if code == EXT_OBJECT_ID:
+        return ObjectId(data)
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode('ascii'))
+    if code == EXT_DATE:
+        return datetime.date.fromordinal(_INT.unpack(data)[0])
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode('ascii'))
+    return msgpack.ExtType(code, data)
+
+
+# Encoder function
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, default=_ext_encoder, use_bin_type=True, datetime=False)
+
+
+# Decoder function
+def msgpack_loads(obj):
+    return msgpack.unpackb(obj, ext_hook=_ext_decoder, raw=False, strict_map_key=False)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+任务 CPU 性能分析
+按 PROFILE_RATE 抽样(或 PROFILE_TASKS 指定的任务每次)用 cProfile 分析任务执行，
+只有耗时超过阈值的才把最耗时的函数写到文件，用于在生产环境定位慢任务的热点。
+"""
+import io
+import os
+import time
+import pstats
+import random
+import cProfile
+import logging
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def start(task_name):
+    """需要分析的任务，开始分析并返回 profiler，否则返回 None"""
+    if task_name not in settings.PROFILE_TASKS and not (settings.PROFILE_RATE and random.random() < settings.PROFILE_RATE):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # 同一线程里已经有其它 profiler 在运行(如任务嵌套调用)
+        return None
+    return profiler
+
+
+def get_profile_dir():
+    """性能分析结果的保存目录: PROFILE_DIR，或者日志文件所在目录下的 profiles"""
+    if settings.PROFILE_DIR:
+        return settings.PROFILE_DIR
+    from . import log_filter
+    if log_filter.file_handler is not None:
+        return os.path.join(os.path.dirname(log_filter.file_handler.baseFilename), 'profiles')
+    return os.path.join('logs', 'profiles')
+
+
+def finish(profiler, task_name, duration, threshold, task_id=None, params=None):
+    """结束分析，耗时超过 threshold(秒) 的保存最耗时的函数"""
+    profiler.disable()
+    if duration < threshold:
+        return None
+    try:
+        stream = io.StringIO()
+        stream.write(f'task: {task_name}\ntask_id: {task_id}\nduration: {duration:.4f}s\n'
+                     f'params: {str(params)[:1000]}\n\n')
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(settings.PROFILE_TOP)
+        folder = get_profile_dir()
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{time.strftime("%Y%m%d-%H%M%S")}_{task_name}_{task_id or os.getpid()}.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(stream.getvalue())
+        _rotate(folder)
+        logger.warning('慢任务的性能分析结果: %s', path)
+        return path
+    except Exception as e:
+        logger.warning('保存性能分析结果出错: %s, %s', task_name, e)
+        return None
+
+
+def _rotate(folder):
+    """只保留最新的 PROFILE_KEEP 个文件"""
+    files = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.txt')]
+    if len(files) <= settings.PROFILE_KEEP:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - settings.PROFILE_KEEP]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -3,17 +3,32 @@
 使用 pulsar 作为消息队列的工具类
 """
 
+import time
+import zlib
+import atexit
+import signal
 import logging
+import itertools
+import threading
+import concurrent.futures
 
 import pulsar
+from celery.signals import worker_shutdown
 from .config_util import config
 from .bson_util import bson_dumps, bson_loads
 
 LOGGER = logging.getLogger(__name__)
 
 CLIENT = None
-PRODUCER = None
+PRODUCERS = {}  # 生产者缓存 {topic: producer}
 CONSUMER = None
+_LOCK = threading.Lock()
+
+
+def _get_int(name, default):
+    """读取整数配置"""
+    value = getattr(config, name)
+    return int(value) if value not in (None, '') else default
 
 
 def get_client():
@@ -24,27 +39,172 @@ def get_client():
     return CLIENT
 
 
-def get_producer():
-    """获取 Pulsar 生产者"""
-    global PRODUCER
-    if PRODUCER is None:
-        client = get_client()
-        PRODUCER = client.create_producer(config.PULSAR_TOPIC)
-    return PRODUCER
+def get_topic(queue=None):
+    """
+    队列对应的 topic
+    配置了 PULSAR_TOPIC_PREFIX 时，每个队列对应一个 topic: PULSAR_TOPIC_PREFIX + 队列名；否则都发到 PULSAR_TOPIC
+    """
+    prefix = config.PULSAR_TOPIC_PREFIX
+    if prefix and queue:
+        return f'{prefix}{queue}'
+    return config.PULSAR_TOPIC
+
+
+def _compression_type(name):
+    """压缩方式(LZ4/ZLib/ZSTD/SNAPPY，不区分大小写)，不配置或不认识的则不压缩"""
+    if not name:
+        return None
+    for key in dir(pulsar.CompressionType):
+        if key.upper() == name.upper():
+            return getattr(pulsar.CompressionType, key)
+    LOGGER.warning(f'Unknown pulsar compression type: {name}')
+    return None
+
+
+def get_producer(topic=None):
+    """获取 Pulsar 生产者(按 topic 缓存，每个 topic 一个)"""
+    topic = topic or config.PULSAR_TOPIC
+    producer = PRODUCERS.get(topic)
+    if producer is None:
+        with _LOCK:
+            producer = PRODUCERS.get(topic)
+            if producer is None:
+                options = {
+                    # 批量发送: 攒够条数或者到时间才真正发给 broker
+                    'batching_enabled': str(config.PULSAR_BATCHING or '1').lower() not in ('0', 'false', 'no'),
+                    'batching_max_messages': _get_int('PULSAR_BATCH_MAX_MESSAGES', 1000),
+                    'batching_max_publish_delay_ms': _get_int('PULSAR_BATCH_MAX_DELAY_MS', 10),
+                    'send_timeout_millis': _get_int('PULSAR_SEND_TIMEOUT_MS', 30000),
+                    'block_if_queue_full': True,  # 发送队列满了就等待，而不是报错
+                }
+                if hasattr(pulsar, 'BatchingType'):
+                    # 按 key 分批，同一批里只有同一个 key 的消息(Key_Shared 订阅按批的 key 分发)
+                    options['batching_type'] = pulsar.BatchingType.KeyBased
+                compression_type = _compression_type(config.PULSAR_COMPRESSION)
+                if compression_type is not None:
+                    options['compression_type'] = compression_type
+                producer = get_client().create_producer(topic, **options)
+                PRODUCERS[topic] = producer
+    return producer
+
+
+KEY_HASH_RANGE = 65536  # Key_Shared 订阅的 key 哈希范围 [0, 65535]
+
 
+def _consumer_type(name):
+    """订阅类型(Exclusive/Shared/Failover/KeyShared，不区分大小写及下划线)，默认 Failover"""
+    name = (name or 'Failover').replace('_', '').upper()
+    for key in dir(pulsar.ConsumerType):
+        if key.upper() == name:
+            return getattr(pulsar.ConsumerType, key)
+    LOGGER.warning(f'Unknown pulsar consumer type: {name}')
+    return pulsar.ConsumerType.Failover
 
-def get_consumer():
-    """获取 Pulsar 消费者"""
+
+def _key_shared_policy():
+    """
+    Key_Shared 订阅的分片: 配置了 PULSAR_SHARD_COUNT(分片数) 及 PULSAR_SHARD_INDEX(本进程的分片序号，从0开始)时，
+    本进程固定消费 key 哈希范围的第 index 段(Sticky)，否则由 broker 自动划分(Auto Split)
+    """
+    count = _get_int('PULSAR_SHARD_COUNT', 0)
+    if count <= 1:
+        return None
+    index = _get_int('PULSAR_SHARD_INDEX', 0)
+    start = KEY_HASH_RANGE * index // count
+    end = KEY_HASH_RANGE * (index + 1) // count - 1
+    return pulsar.ConsumerKeySharedPolicy(key_shared_mode=pulsar.KeySharedMode.Sticky, sticky_ranges=[(start, end)])
+
+
+def get_consumer(topics=None):
+    """
+    获取 Pulsar 消费者
+    订阅类型见 PULSAR_CONSUMER_TYPE，使用 KeyShared 时多个进程可以并行消费，同一个 key(公司/用户)的消息仍保持顺序
+    :param topics: 订阅的 topic 列表，不传则只订阅 PULSAR_TOPIC
+    """
     global CONSUMER
     if CONSUMER is None:
         client = get_client()
-        CONSUMER = client.subscribe(config.PULSAR_TOPIC, 'my-sub',
-                                    consumer_type=pulsar.ConsumerType.Failover)
+        # 批量接收: 攒够条数/字节数或者到时间就返回一批(batch_receive)
+        batch_policy = pulsar.ConsumerBatchReceivePolicy(_get_int('PULSAR_BATCH_RECEIVE_MESSAGES', 100),
+                                                         _get_int('PULSAR_BATCH_RECEIVE_BYTES', 10 * 1024 * 1024),
+                                                         _get_int('PULSAR_BATCH_RECEIVE_TIMEOUT_MS', 100))
+        options = {'consumer_type': _consumer_type(config.PULSAR_CONSUMER_TYPE), 'batch_receive_policy': batch_policy}
+        if options['consumer_type'] == pulsar.ConsumerType.KeyShared:
+            key_shared_policy = _key_shared_policy()
+            if key_shared_policy is not None:
+                options['key_shared_policy'] = key_shared_policy
+        CONSUMER = client.subscribe(topics or config.PULSAR_TOPIC, config.PULSAR_SUBSCRIPTION or 'my-sub', **options)
     return CONSUMER
 
 
-def send_message(task_name, args=None, kwargs=None, user_id=None, company_id=None, queue=None, priority=0):
+class PulsarSendError(Exception):
+    """异步发送消息失败"""
+
+
+def _on_send(future, callback=None):
+    """异步发送的回调: 结果设置到 future 上(在 pulsar 的 IO 线程里执行，不要做耗时操作)"""
+    def on_send(result, msg_id):
+        if result == pulsar.Result.Ok:
+            future.set_result(msg_id)
+        else:
+            LOGGER.error(f'Pulsar send message failed: {result}')
+            future.set_exception(PulsarSendError(result))
+        if callback is not None:
+            try:
+                callback(result, msg_id)
+            except Exception as e:
+                LOGGER.exception(f'Pulsar send callback error: {e}')
+    return on_send
+
+
+def flush():
+    """把各生产者缓存中还没发出去的消息发送出去"""
+    for topic, producer in list(PRODUCERS.items()):
+        try:
+            producer.flush()
+        except Exception as e:
+            LOGGER.exception(f'Pulsar producer flush error: {topic}, {e}')
+
+
+def close(**kwargs):
+    """发送完缓存的消息，关闭生产者、消费者及客户端(worker 退出时自动调用)"""
+    global CLIENT, CONSUMER
+    flush()
+    with _LOCK:
+        producers = list(PRODUCERS.values())
+        PRODUCERS.clear()
+    for producer in producers:
+        try:
+            producer.close()
+        except Exception as e:
+            LOGGER.warning(f'Pulsar producer close error: {e}')
+    if CONSUMER is not None:
+        try:
+            CONSUMER.close()
+        except Exception as e:
+            LOGGER.warning(f'Pulsar consumer close error: {e}')
+        CONSUMER = None
+    if CLIENT is not None:
+        try:
+            CLIENT.close()
+        except Exception as e:
+            LOGGER.warning(f'Pulsar client close error: {e}')
+        CLIENT = None
+
+
+worker_shutdown.connect(close, weak=False)
+atexit.register(close)
+
+
+def send_message(task_name, args=None, kwargs=None, user_id=None, company_id=None, queue=None, priority=0,
+                 sync=True, callback=None):
     """发送消息到 Pulsar 队列
+    默认同步发送，返回 MessageId，发送失败抛出异常；
+    sync=False 时异步发送(send_async，由生产者批量发出，吞吐量高很多)，返回 concurrent.futures.Future:
+    发送成功后 future.result() 是 MessageId，失败则抛出 PulsarSendError；worker 退出时会把缓存的消息发完
+    callback: 异步发送完成的回调 callback(result, msg_id)
+    队列对应的 topic 见 get_topic
+    有 company_id/user_id 时作为消息的 partition key，同一个公司/用户的消息进入同一分区、Key_Shared 订阅时由同一个消费者按顺序处理
     约定的消息结构：
     {
         'task': '任务名称',
@@ -65,10 +225,16 @@ def send_message(task_name, args=None, kwargs=None, user_id=None, company_id=Non
         'queue': queue,
         'priority': priority,
     })
-    producer = get_producer()
-    result = producer.send(message.encode('utf-8'))
-    # producer.close()
-    return result
+    options = {}
+    partition_key = company_id or user_id
+    if partition_key:
+        options['partition_key'] = str(partition_key)
+    producer = get_producer(get_topic(queue))
+    if sync:
+        return producer.send(message.encode('utf-8'), **options)
+    future = concurrent.futures.Future()
+    producer.send_async(message.encode('utf-8'), _on_send(future, callback), **options)
+    return future
 
 
 def receive_message(timeout_millis=None):
@@ -96,9 +262,12 @@ def receive_message(timeout_millis=None):
         consumer.negative_acknowledge(msg)
 
 
-def run_task(data):
-    """执行 Pulsar 队列中的任务"""
-    from ..celery_base_task import BaseTask
+def run_task(data, **options):
+    """
+    执行 Pulsar 队列中的任务(转发到 celery 队列)
+    :param options: apply_async 的其它参数(如批量转发时共用的 producer)
+    """
+    from .celery_base_task import BaseTask
     task_name = data.get('task')
     args = data.get('args')
     kwargs = data.get('kwargs')
@@ -112,6 +281,143 @@ def run_task(data):
     if task is None:
         LOGGER.error(f'Task {task_name} not found')
         return None
-    result = task.apply_async(args=args, kwargs=kwargs, queue=queue, priority=priority)
+    result = task.apply_async(args=args, kwargs=kwargs, queue=queue, priority=priority, **options)
     # 处理完成后，返回处理结果
     return result
+
+
+class BridgeStats(object):
+    """转发的统计: 吞吐量及延迟(消息发布到转发完成的时间)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.total = 0  # 累计转发成功的数量
+        self._reset()
+
+    def _reset(self):
+        self.window_start = time.time()
+        self.received = 0
+        self.dispatched = 0
+        self.failed = 0  # 转发失败(负确认，稍后重发)
+        self.dropped = 0  # 无法处理而丢弃(解析失败、任务不存在)
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+
+    def add(self, received=0, dispatched=0, failed=0, dropped=0, lags=()):
+        with self._lock:
+            self.received += received
+            self.dispatched += dispatched
+            self.total += dispatched
+            self.failed += failed
+            self.dropped += dropped
+            for lag in lags:
+                self.lag_sum += lag
+                self.lag_max = max(self.lag_max, lag)
+
+    def report(self, in_flight=0):
+        """输出并清空本时间窗口的统计"""
+        with self._lock:
+            seconds = max(time.time() - self.window_start, 0.001)
+            lag_avg = self.lag_sum / self.dispatched if self.dispatched else 0.0
+            LOGGER.info(f'Pulsar bridge: {self.dispatched / seconds:.1f} msg/s, received: {self.received}, '
+                        f'dispatched: {self.dispatched}, failed: {self.failed}, dropped: {self.dropped}, '
+                        f'lag avg: {lag_avg:.3f}s, lag max: {self.lag_max:.3f}s, in flight: {in_flight}, '
+                        f'total: {self.total}')
+            self._reset()
+
+
+def _dispatch_batch(app, consumer, messages, stats):
+    """把一批 pulsar 消息转发到 celery 队列(共用一个 producer 批量写入)，写入成功后才确认"""
+    from kombu.exceptions import OperationalError
+    from .celery_util import bulk_publish
+    from .celery_base_task import BaseTask
+    sent, dropped, lags = [], [], []
+    try:
+        with app.producer_or_acquire() as producer:
+            connection_errors = (OperationalError,) + tuple(producer.connection.connection_errors)
+            with bulk_publish(producer):
+                for msg in messages:
+                    try:
+                        data = bson_loads(msg.data().decode('utf-8'))
+                    except Exception as e:
+                        LOGGER.error(f'Pulsar message decode error, dropped: {e}')
+                        dropped.append(msg)
+                        continue
+                    if data.get('task') not in BaseTask.tasks:
+                        LOGGER.error(f'Task {data.get("task")} not found, dropped')
+                        dropped.append(msg)  # 任务不存在，重发也没用
+                        continue
+                    try:
+                        run_task(data, producer=producer)
+                    except connection_errors:
+                        raise
+                    except Exception as e:
+                        # 参数不对等，重发也没用
+                        LOGGER.exception(f'Task {data.get("task")} dispatch error, dropped: {e}')
+                        dropped.append(msg)
+                        continue
+                    sent.append(msg)
+    except Exception as e:
+        # 写入 celery broker 失败，整批负确认，Broker 将在超时后重发消息(已写入的会重复，至少一次)
+        LOGGER.exception(f'Pulsar bridge dispatch error: {e}')
+        for msg in messages:
+            consumer.negative_acknowledge(msg)
+        stats.add(received=len(messages), failed=len(messages))
+        return
+    now = time.time()
+    for msg in sent:
+        consumer.acknowledge(msg)
+        lags.append(max(now - msg.publish_timestamp() / 1000.0, 0))
+    for msg in dropped:
+        consumer.acknowledge(msg)
+    stats.add(received=len(messages), dispatched=len(sent), dropped=len(dropped), lags=lags)
+
+
+def run_bridge(queues=None, max_in_flight=None, report_interval=None):
+    """
+    pulsar -> celery 转发(main.py -m pulsar-bridge)
+    批量接收 pulsar 消息，经 run_task 批量转发到 celery 队列，转发成功后才确认(进程崩溃不会丢消息)
+    :param queues: 转发的队列，配置了 PULSAR_TOPIC_PREFIX 时订阅这些队列各自的 topic
+    :param max_in_flight: 同时在转发中的批次数量上限(PULSAR_BRIDGE_IN_FLIGHT)，也是转发线程(通道)数量
+        每批消息按 key 拆到各通道，每个通道单线程依次转发，同一个 key 的消息保持顺序
+    :param report_interval: 输出统计的间隔(秒，PULSAR_BRIDGE_REPORT_INTERVAL)
+    """
+    from celery import current_app
+    app = current_app._get_current_object()  # 转发线程里取不到当前 app，先取出来传过去
+    max_in_flight = max_in_flight or _get_int('PULSAR_BRIDGE_IN_FLIGHT', 4)
+    report_interval = report_interval or _get_int('PULSAR_BRIDGE_REPORT_INTERVAL', 30)
+    topics = sorted({get_topic(queue) for queue in queues}) if queues and config.PULSAR_TOPIC_PREFIX else None
+    consumer = get_consumer(topics)
+    stats = BridgeStats()
+    slots = threading.BoundedSemaphore(max_in_flight)
+    pending = set()  # 在转发中的批次
+    lanes = [concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'pulsar-bridge-{i}')
+             for i in range(max_in_flight)]
+    counter = itertools.count()  # 没有 key 的消息轮流分到各通道
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    LOGGER.info(f'Pulsar bridge started, topics: {topics or config.PULSAR_TOPIC}, max in flight: {max_in_flight}')
+    last_report = time.time()
+    try:
+        while not stopping.is_set():
+            messages = consumer.batch_receive()
+            batches = {}
+            for msg in messages or ():
+                key = msg.partition_key()
+                lane = zlib.crc32(key.encode('utf-8')) if key else next(counter)
+                batches.setdefault(lane % max_in_flight, []).append(msg)
+            for lane, batch in batches.items():
+                slots.acquire()  # 在转发中的批次达到上限时，等待
+                future = lanes[lane].submit(_dispatch_batch, app, consumer, batch, stats)
+                pending.add(future)
+                future.add_done_callback(lambda f: (pending.discard(f), slots.release()))
+            if time.time() - last_report >= report_interval:
+                stats.report(in_flight=len(pending))
+                last_report = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for executor in lanes:
+            executor.shutdown(wait=True)  # 等待在转发中的批次完成(确认)
+        stats.report()
+        close()
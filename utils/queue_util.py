@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+队列深度采样
+后台线程使用同一个 broker 连接，按固定间隔读取所有队列的任务数量并缓存，
+其它地方(自动扩缩容、告警、背压等)读取缓存即可，不需要访问 broker。
+"""
+import os
+import time
+import logging
+import threading
+
+from celery import current_app
+import settings
+
+logger = logging.getLogger(__name__)
+
+RATE_SMOOTHING = 0.5  # 速率的平滑系数(指数移动平均)，越大越偏向最新的采样
+SAMPLER = None  # 进程内的采样器
+
+
+class QueueSampler(object):
+    """队列深度采样器"""
+
+    def __init__(self, app=None, queues=None, interval=None):
+        self.app = app or current_app
+        self.queues = tuple(queues or settings.ALL_QUEUES)
+        self.interval = interval or settings.QUEUE_SAMPLE_INTERVAL
+        self.pid = os.getpid()
+        self.depths = {key: 0 for key in self.queues}  # 各队列的任务数
+        self.rates = {key: 0.0 for key in self.queues}  # 各队列任务数的变化速率(个/秒)，正数表示在堆积，负数表示在消化
+        self.sample_time = 0  # 最近一次采样的时间
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _get_channel(self):
+        """获取(复用)采样用的 channel"""
+        if self._connection is None:
+            self._connection = self.app.connection_for_read()
+        if self._channel is None:
+            self._channel = self._connection.channel()
+        return self._channel
+
+    def _release(self):
+        """释放连接，下次采样时重连"""
+        for obj in (self._channel, self._connection):
+            try:
+                obj and obj.close()
+            except Exception:
+                pass
+        self._channel = self._connection = None
+
+    def _queue_size(self, queue):
+        """读取单个队列的任务数量"""
+        channel = self._get_channel()
+        try:
+            return channel.queue_declare(queue, passive=True).message_count
+        except self._connection.channel_errors:
+            # 队列还不存在(RabbitMQ 会关闭出错的 channel，需要重新打开；先关闭旧的，避免 channel 越积越多)
+            try:
+                channel.close()
+            except Exception:
+                pass
+            self._channel = None
+            return 0
+
+    def sample(self):
+        """采样一次，更新各队列的任务数量及变化速率"""
+        now = time.time()
+        depths = {}
+        try:
+            for key in self.queues:
+                depths[key] = self._queue_size(key)
+        except Exception as e:
+            logger.warning('采样队列深度失败:%s', e)
+            self._release()
+            return self.depths
+        rates = dict(self.rates)
+        duration = now - self.sample_time
+        if self.sample_time and duration > 0:
+            for key, size in depths.items():
+                rate = (size - self.depths.get(key, 0)) / duration
+                rates[key] = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * rates.get(key, 0.0)
+        # 整体替换，读取时不需要加锁
+        self.depths, self.rates, self.sample_time = depths, rates, now
+        return depths
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+        self._release()
+
+    def start(self):
+        """启动后台采样线程(启动前先同步采样一次，保证缓存里有值)"""
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='QueueSampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止后台采样线程"""
+        self._stop_event.set()
+
+    def get_depth(self, queue):
+        """获取缓存的队列任务数量"""
+        return self.depths.get(queue, 0)
+
+    def get_rate(self, queue):
+        """获取缓存的队列任务数量变化速率(个/秒)，正数表示在堆积，负数表示在消化"""
+        return self.rates.get(queue, 0.0)
+
+    def snapshot(self):
+        """获取缓存的所有队列信息"""
+        return {'time': self.sample_time, 'depths': dict(self.depths), 'rates': dict(self.rates)}
+
+
+def get_sampler():
+    """获取进程内的采样器(首次调用时启动；fork 出的子进程里线程不存在，会重新创建)"""
+    global SAMPLER
+    if SAMPLER is None or SAMPLER.pid != os.getpid():
+        SAMPLER = QueueSampler().start()
+    return SAMPLER
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时分析
+main.py 按阶段计时(配置、日志、任务模块 import、任务注册、清理旧任务、连接 broker)，
+设置环境变量 STARTUP_TRACE(报告文件路径) 时输出按耗时排序的报告；
+设置 STARTUP_BUDGET(秒) 时，启动耗时超出则退出，用于发现任务模块 import 变慢等问题。
+"""
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STARTUP_TRACE = os.environ.get('STARTUP_TRACE') or ''  # 启动耗时报告的文件路径，为空则不输出
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET') or 0)  # 启动耗时上限(秒)，0 表示不限制
+STARTUP_TOP_MODULES = int(os.environ.get('STARTUP_TOP_MODULES') or 30)  # 报告里列出最慢的多少个任务模块
+
+START_TIME = time.time()  # main.py 最先 import 本模块，以此作为启动时间
+PHASES = []  # [(阶段名称, 耗时秒数)]
+
+
+@contextmanager
+def phase(name):
+    """记录一个阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASES.append((name, time.perf_counter() - start))
+
+
+def enabled():
+    return bool(STARTUP_TRACE or STARTUP_BUDGET)
+
+
+def build_report():
+    """生成报告: 总耗时、各阶段耗时、最慢的任务模块 import 耗时(都按耗时倒序)"""
+    from .import_util import IMPORT_TIMES
+    total = time.time() - START_TIME
+    lines = [f'startup total: {total:.3f}s (pid: {os.getpid()}, budget: {STARTUP_BUDGET or "-"})', '', 'phases:']
+    for name, seconds in sorted(PHASES, key=lambda x: x[1], reverse=True):
+        lines.append(f'  {seconds:9.4f}s  {name}')
+    if IMPORT_TIMES:
+        lines += ['', f'module imports (top {STARTUP_TOP_MODULES} of {len(IMPORT_TIMES)}):']
+        for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda x: x[1], reverse=True)[:STARTUP_TOP_MODULES]:
+            lines.append(f'  {seconds:9.4f}s  {name}')
+    return total, '\n'.join(lines) + '\n'
+
+
+def report():
+    """输出启动耗时报告，超出 STARTUP_BUDGET 则退出"""
+    if not enabled():
+        return None
+    total, text = build_report()
+    if STARTUP_TRACE:
+        folder = os.path.dirname(STARTUP_TRACE)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(STARTUP_TRACE, 'w', encoding='utf-8') as f:
+            f.write(text)
+    logger.info('启动耗时报告:\n%s', text)
+    if STARTUP_BUDGET and total > STARTUP_BUDGET:
+        logger.error('启动耗时 %.3f 秒，超出限制 %s 秒', total, STARTUP_BUDGET)
+        raise SystemExit(f'startup took {total:.3f}s, exceeds STARTUP_BUDGET={STARTUP_BUDGET}s')
+    return total
@@ -127,10 +127,11 @@ def base64_decode(s):
     return decode2str(res)
 
 
-def gzip_encode(content):
+def gzip_encode(content, level=9):
     """
     使用 gzip 压缩字符串
     :param {string} content: 明文字符串
+    :param {int} level: 压缩级别(1~9)，1 最快，9 压缩率最高
     :return {string}: 压缩后的字符串
     """
     if not isinstance(content, (str, bytes, bytearray)):
@@ -138,7 +139,7 @@ def gzip_encode(content):
         content = json.dumps(json_serializable(content))
     if isinstance(content, str):
         content = encode2bytes(content)
-    return gzip.compress(content)
+    return gzip.compress(content, compresslevel=level)
 
 
 def gzip_decode(content):
@@ -152,10 +153,11 @@ def gzip_decode(content):
     return decode2str(res)
 
 
-def zlib_encode(content):
+def zlib_encode(content, level=zlib.Z_BEST_COMPRESSION):
     """
     使用 zlib 压缩字符串
     :param {string} content: 明文字符串
+    :param {int} level: 压缩级别(1~9)，1 最快，9 压缩率最高
     :return {string}: 压缩后的字符串
     """
     if not isinstance(content, (str, bytes, bytearray)):
@@ -163,7 +165,7 @@ def zlib_encode(content):
         content = json.dumps(json_serializable(content))
     if isinstance(content, str):
         content = encode2bytes(content)
-    return zlib.compress(content, zlib.Z_BEST_COMPRESSION)
+    return zlib.compress(content, level)
 
 
 def zlib_decode(content):
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+yield 生成器任务的流式输出
+生成器任务每产出一批结果，就写到指定的输出位置，而不是全部拼成一个 list 最后才返回，worker 内存不会随输出增长。
+任务设置 stream_sink 属性即可启用，输出位置可以是：
+    redis://:@127.0.0.1:6379/3  写到 redis stream，key 为 "{APP_NAME}:stream:{task_id}"
+    file:///data/streams  追加写到本地文件 "{目录}/{task_name}/{task_id}.jsonl"，每行一个结果
+    task:{task_name}  每批结果作为参数，抛出一个后续任务
+任务重试时，先清空上一次执行写到 redis stream / 文件 的部分结果，避免重复输出(后续任务已抛出的则无法撤回)
+"""
+import os
+import logging
+
+from celery import current_app
+
+from .bson_util import bson_dumps
+import settings
+
+logger = logging.getLogger(__name__)
+
+STREAM_TTL = int(os.environ.get('STREAM_TTL') or 24 * 3600)  # redis stream 的过期时间(秒)
+SINKS = {}  # 已创建的输出位置
+
+
+class RedisStreamSink(object):
+    """写到 redis stream"""
+
+    def __init__(self, url):
+        from .db_util import get_redis_client
+        self.conn = get_redis_client(url)
+
+    def write(self, task_name, task_id, items):
+        key = f'{settings.APP_NAME}:stream:{task_id}'
+        pipe = self.conn.pipeline(transaction=False)
+        for item in items:
+            pipe.xadd(key, {'task': task_name, 'data': bson_dumps(item)})
+        pipe.expire(key, STREAM_TTL)
+        pipe.execute()
+
+    def reset(self, task_name, task_id):
+        self.conn.delete(f'{settings.APP_NAME}:stream:{task_id}')
+
+
+class FileSink(object):
+    """追加写到本地文件，每行一个结果"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def _file(self, task_name, task_id):
+        return os.path.join(self.path, task_name, f'{task_id}.jsonl')
+
+    def write(self, task_name, task_id, items):
+        file_path = self._file(task_name, task_id)
+        file_dir = os.path.dirname(file_path)
+        # 没有目录，则先创建目录，避免因此报错
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir, exist_ok=True)
+        with open(file_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(bson_dumps(item) + '\n' for item in items))
+
+    def reset(self, task_name, task_id):
+        try:
+            os.remove(self._file(task_name, task_id))
+        except FileNotFoundError:
+            pass
+
+
+class TaskSink(object):
+    """每批结果作为参数，抛出一个后续任务"""
+
+    def __init__(self, task_name):
+        self.task_name = task_name
+
+    def write(self, task_name, task_id, items):
+        current_app.send_task(self.task_name, args=(items,))
+
+    def reset(self, task_name, task_id):
+        pass  # 已抛出的后续任务无法撤回
+
+
+def get_sink(url):
+    """获取输出位置"""
+    sink = SINKS.get(url)
+    if sink is None:
+        if url.startswith(('redis://', 'rediss://')):
+            sink = RedisStreamSink(url)
+        elif url.startswith('task:'):
+            sink = TaskSink(url[len('task:'):])
+        else:
+            sink = FileSink(url[len('file://'):] if url.startswith('file://') else url)
+        SINKS[url] = sink
+    return sink
+
+
+def stream_results(gen, url, task_name, task_id, batch=100, retries=0):
+    """
+    逐批输出生成器的结果
+    :param gen: 生成器
+    :param url: 输出位置
+    :param task_name: 任务名
+    :param task_id: 任务id
+    :param batch: 每批输出的数量
+    :param retries: 任务的重试次数，重试时先清空上一次执行输出的部分结果
+    :return: 输出的汇总信息
+    """
+    sink = get_sink(url)
+    if retries:
+        sink.reset(task_name, task_id)
+    items = []
+    count = 0
+    result = None
+    while True:
+        try:
+            items.append(next(gen))
+        except StopIteration as e:
+            result = e.value
+            break
+        count += 1
+        if len(items) >= batch:
+            sink.write(task_name, task_id, items)
+            items = []
+    if items:
+        sink.write(task_name, task_id, items)
+    logger.debug('生成器任务输出完成: %s, %s, 数量:%s', task_name, task_id, count)
+    return {'task_id': task_id, 'count': count, 'sink': url, 'result': result}